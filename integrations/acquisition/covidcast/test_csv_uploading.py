@@ -30,6 +30,7 @@ class CsvUploadingTests(unittest.TestCase):
         database='epidata')
     cur = cnx.cursor()
     cur.execute('truncate table covidcast')
+    cur.execute('truncate table covidcast_series')
     cnx.commit()
     cur.close()
 
@@ -73,7 +74,8 @@ class CsvUploadingTests(unittest.TestCase):
       f.write('file name is wrong\n')
 
     # upload CSVs
-    args = MagicMock(data_dir=data_dir, test=False)
+    args = MagicMock(
+        data_dir=data_dir, test=False, bulk_load=False, num_workers=1)
     main(args)
 
     # request CSV data from the API
@@ -126,3 +128,88 @@ class CsvUploadingTests(unittest.TestCase):
     self.assertIsNotNone(os.stat(path))
     path = data_dir + '/archive/failed/unknown/hello.csv'
     self.assertIsNotNone(os.stat(path))
+
+  def test_uploading_bulk_load(self):
+    """Upload CSVs with `LOAD DATA LOCAL INFILE`, validating rows in SQL."""
+
+    # make some fake data files
+    data_dir = 'covid/data'
+    source_receiving_dir = data_dir + '/receiving/src-bulk'
+    os.makedirs(source_receiving_dir, exist_ok=True)
+
+    # valid, with missing values written as pandas would read them, and a
+    # repeated geo value
+    with open(source_receiving_dir + '/20200419_hrr_test.csv', 'w') as f:
+      f.write('geo_id,val,se,sample_size\n')
+      f.write('1,1,0.1,10\n')
+      f.write('2,2,NULL,N/A\n')
+      f.write('3.0,3,0.3,30\n')
+      f.write('3,4,0.4,40\n')
+
+    # invalid, since pandas reads this `geo_id` as missing
+    with open(source_receiving_dir + '/20200419_state_test.csv', 'w') as f:
+      f.write('geo_id,val,se,sample_size\n')
+      f.write('NA,1,0.1,10\n')
+      f.write('ca,2,0.2,20\n')
+
+    # upload CSVs
+    args = MagicMock(
+        data_dir=data_dir, test=False, bulk_load=True, num_workers=1)
+    main(args)
+
+    # request CSV data from the API
+    response = Epidata.covidcast(
+        'src-bulk', 'test', 'day', 'hrr', 20200419, '*')
+
+    # verify data matches the CSV, keeping the last of the repeated rows
+    self.assertEqual(response, {
+      'result': 1,
+      'epidata': [
+        {
+          'time_value': 20200419,
+          'geo_value': '1',
+          'value': 1,
+          'stderr': 0.1,
+          'sample_size': 10,
+          'direction': None,
+        },
+        {
+          'time_value': 20200419,
+          'geo_value': '2',
+          'value': 2,
+          'stderr': None,
+          'sample_size': None,
+          'direction': None,
+        },
+        {
+          'time_value': 20200419,
+          'geo_value': '3',
+          'value': 4,
+          'stderr': 0.4,
+          'sample_size': 40,
+          'direction': None,
+        },
+       ],
+      'message': 'success',
+    })
+
+    # verify that the repeated row was counted once in its time-series
+    self.cur.execute('''
+      select geo_value, series_length from covidcast_series
+      where source = 'src-bulk' and geo_type = 'hrr'
+      order by geo_value
+    ''')
+    self.assertEqual(list(self.cur), [('1', 1), ('2', 1), ('3', 1)])
+
+    # verify that the valid rows of the invalid file were uploaded
+    response = Epidata.covidcast(
+        'src-bulk', 'test', 'day', 'state', 20200419, '*')
+    self.assertEqual(response['result'], 1)
+    self.assertEqual(
+        [row['geo_value'] for row in response['epidata']], ['ca'])
+
+    # verify that the CSVs were archived
+    path = data_dir + '/archive/successful/src-bulk/20200419_hrr_test.csv.gz'
+    self.assertIsNotNone(os.stat(path))
+    path = data_dir + '/archive/failed/src-bulk/20200419_state_test.csv'
+    self.assertIsNotNone(os.stat(path))
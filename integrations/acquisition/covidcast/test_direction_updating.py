@@ -30,6 +30,8 @@ class DirectionUpdatingTests(unittest.TestCase):
         database='epidata')
     cur = cnx.cursor()
     cur.execute('truncate table covidcast')
+    cur.execute('truncate table covidcast_series')
+    cur.execute('truncate table covidcast_stdev_cache')
     cnx.commit()
     cur.close()
 
@@ -83,6 +85,12 @@ class DirectionUpdatingTests(unittest.TestCase):
     ''')
     self.cnx.commit()
 
+    # rows were inserted directly, so summarize them explicitly
+    database = Database()
+    database.connect()
+    database.rebuild_series()
+    database.disconnect(True)
+
     # update direction (only 20200417 has enough history)
     args = MagicMock(test=False)
     main(args)
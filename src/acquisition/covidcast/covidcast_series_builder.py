@@ -0,0 +1,45 @@
+"""Rebuilds the `covidcast_series` summary table from the `covidcast` table.
+
+This must be run once after the `covidcast_series` table is created on a
+database which already has `covidcast` rows, and again whenever `covidcast` is
+modified other than by the acquisition code.
+"""
+
+# standard library
+import argparse
+
+# first party
+from delphi.epidata.acquisition.covidcast.database import Database
+
+
+def get_argument_parser():
+  """Define command line arguments."""
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+    '--test',
+    action='store_true',
+    help='do a dry run without committing changes')
+  return parser
+
+
+def main(args, database_impl=Database):
+  """Rebuild the time-series summary of covidcast signals.
+
+  `args` parsed command-line arguments
+  """
+
+  database = database_impl()
+  database.connect()
+  commit = False
+
+  try:
+    database.rebuild_series()
+    commit = not args.test
+  finally:
+    print('committed=%s' % str(commit))
+    database.disconnect(commit)
+
+
+if __name__ == '__main__':
+  main(get_argument_parser().parse_args())
@@ -2,6 +2,7 @@
 
 # standard library
 import argparse
+import concurrent.futures
 import os
 
 # first party
@@ -10,6 +11,19 @@ from delphi.epidata.acquisition.covidcast.database import Database
 from delphi.epidata.acquisition.covidcast.file_archiver import FileArchiver
 
 
+# number of times a worker retries a file whose transaction was rolled back to
+# resolve a deadlock
+MAX_DEADLOCK_RETRIES = 3
+
+
+class UploadError(Exception):
+  """An upload failed after worker threads had committed other uploads."""
+
+  def __init__(self, num_rows):
+    super().__init__('upload failed after %d rows were uploaded' % num_rows)
+    self.num_rows = num_rows
+
+
 def get_argument_parser():
   """Define command line arguments."""
 
@@ -21,6 +35,20 @@ def get_argument_parser():
     '--test',
     action='store_true',
     help='do a dry run without committing changes')
+  parser.add_argument(
+    '--bulk_load',
+    action='store_true',
+    help='have the database server parse and validate CSVs')
+  parser.add_argument(
+    '--num_workers',
+    type=int,
+    default=1,
+    choices=range(1, Database.POOL_SIZE),
+    help=(
+      'number of CSVs to upload concurrently, each in its own transaction; '
+      'files of the same signal and geo type update the same time-series '
+      'summaries, so they are mostly uploaded one at a time, and a file is '
+      'retried if its transaction deadlocks'))
   return parser
 
 
@@ -28,11 +56,30 @@ def scan_upload_archive(
     data_dir,
     database,
     csv_importer_impl=CsvImporter,
-    file_archiver_impl=FileArchiver):
+    file_archiver_impl=FileArchiver,
+    bulk_load=False,
+    num_workers=1,
+    database_impl=Database,
+    dry_run=False):
   """Find CSVs, upload them to the database, and archive them.
 
   data_dir: top-level directory where CSVs are stored
   database: an open connection to the epidata database
+  bulk_load: if true, have the database load and validate each CSV with
+    `LOAD DATA LOCAL INFILE` (for which `database` must allow local files),
+    otherwise parse and validate CSVs locally
+  num_workers: number of files to upload concurrently; a file whose upload
+    deadlocks is retried up to `MAX_DEADLOCK_RETRIES` times
+  database_impl: used by workers to open their own database connections
+  dry_run: if true, workers roll back their changes instead of committing
+
+  With a single worker, rows from all files are written within the single
+  transaction of the given database connection, and are committed (or not) by
+  the caller. With multiple workers, each file is instead uploaded by a worker
+  thread on its own connection, and is committed (unless `dry_run`) before the
+  file is archived. If an upload fails, no more uploads are started, the files
+  of uploads which were already started are archived as they complete, and
+  `UploadError` is then raised from the first failure.
 
   The CSV storage layout is assumed to be as follows:
 
@@ -41,6 +88,8 @@ def scan_upload_archive(
 
   Status above is one of `successful` or `failed`. See the accompanying readme
   for further details.
+
+  Return the number of rows which were uploaded.
   """
 
   receiving_dir = os.path.join(data_dir, 'receiving')
@@ -61,46 +110,125 @@ def scan_upload_archive(
     compress = True
     file_archiver_impl.archive_file(path_src, path_dst, filename, compress)
 
-  # collect files
-  results = list(csv_importer_impl.find_csv_files(receiving_dir))
-  print('found %d files' % len(results))
-
-  # iterate over each file
-  for path, details in results:
-    print('handling ', path)
-    path_src, filename = os.path.split(path)
-
-    if not details:
-      # file path or name was invalid, source is unknown
-      archive_as_failed(path_src, filename, 'unknown')
-      continue
-
+  # helper to upload a file, returning whether all of its rows were valid, and
+  # the number of rows which were uploaded
+  def upload(database, path, details):
     (source, signal, time_type, geo_type, time_value) = details
 
-    # iterate over rows and upload to the database
+    if bulk_load:
+      # let the database parse the file and upload the valid rows
+      return database.bulk_load_csv(
+          path, source, signal, time_type, geo_type, time_value)
+
+    # collect valid rows and upload them to the database in batches
     all_rows_valid = True
+    rows = []
     for row_values in csv_importer_impl.load_csv(path, geo_type):
       if not row_values:
         all_rows_valid = False
         continue
 
-      database.insert_or_update(
-          source,
-          signal,
-          time_type,
-          geo_type,
-          time_value,
-          row_values.geo_value,
-          row_values.value,
-          row_values.stderr,
-          row_values.sample_size)
-
-    # archive the current file based on validation results
+      rows.append((
+        row_values.geo_value,
+        row_values.value,
+        row_values.stderr,
+        row_values.sample_size,
+      ))
+
+    if rows:
+      database.insert_or_update_file(
+          source, signal, time_type, geo_type, time_value, rows)
+
+    return (all_rows_valid, len(rows))
+
+  # helper for worker threads to upload a file on their own connection, since
+  # connections can't be shared between threads; concurrent uploads may
+  # deadlock, in which case the file is uploaded again
+  def upload_in_worker(path, details):
+    for attempt in range(MAX_DEADLOCK_RETRIES + 1):
+      worker_database = database_impl()
+      worker_database.connect(allow_local_infile=bulk_load)
+      commit = False
+      try:
+        result = upload(worker_database, path, details)
+        commit = not dry_run
+        return result
+      except Exception as error:
+        if attempt == MAX_DEADLOCK_RETRIES or not Database.is_deadlock(error):
+          raise
+        print('deadlock while uploading %s, retrying' % path)
+      finally:
+        worker_database.disconnect(commit)
+
+  # helper to archive the current file based on validation results
+  def archive(path, details, all_rows_valid):
+    path_src, filename = os.path.split(path)
+    source = details[0]
     if all_rows_valid:
       archive_as_successful(path_src, filename, source)
     else:
       archive_as_failed(path_src, filename, source)
 
+  # collect files
+  results = list(csv_importer_impl.find_csv_files(receiving_dir))
+  print('found %d files' % len(results))
+
+  # files with valid names, and (with multiple workers) their pending uploads
+  uploads = []
+  num_rows = 0
+
+  # helper to archive files in the main thread as their uploads complete,
+  # returning the first failure, after which no more uploads are started
+  def archive_uploads():
+    nonlocal num_rows
+    error = None
+    for path, details, future in uploads:
+      if future.cancelled():
+        continue
+      try:
+        all_rows_valid, num_file_rows = future.result()
+      except Exception as e:
+        if error is None:
+          error = e
+          for _, _, pending_future in uploads:
+            pending_future.cancel()
+        continue
+      num_rows += num_file_rows
+      archive(path, details, all_rows_valid)
+    return error
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as pool:
+    try:
+      # iterate over each file
+      for path, details in results:
+        print('handling ', path)
+
+        if not details:
+          # file path or name was invalid, source is unknown
+          path_src, filename = os.path.split(path)
+          archive_as_failed(path_src, filename, 'unknown')
+          continue
+
+        if num_workers > 1:
+          uploads.append(
+              (path, details, pool.submit(upload_in_worker, path, details)))
+        else:
+          all_rows_valid, num_file_rows = upload(database, path, details)
+          num_rows += num_file_rows
+          archive(path, details, all_rows_valid)
+    except BaseException:
+      # don't start any more uploads, but archive those which were committed
+      for path, details, future in uploads:
+        future.cancel()
+      archive_uploads()
+      raise
+
+    error = archive_uploads()
+    if error is not None:
+      raise UploadError(num_rows) from error
+
+  return num_rows
+
 
 def main(
     args,
@@ -109,16 +237,29 @@ def main(
   """Find, parse, and upload covidcast signals."""
 
   database = database_impl()
-  database.connect()
-  num_starting_rows = database.count_all_rows()
+  database.connect(allow_local_infile=args.bulk_load)
+  num_uploaded_rows = 0
   commit = False
 
+  # with multiple workers, uploaded rows are committed by the workers, even if
+  # the upload of some other file fails
+  workers_commit = args.num_workers > 1 and not args.test
+
   try:
-    scan_upload_archive_impl(args.data_dir, database)
+    num_uploaded_rows = scan_upload_archive_impl(
+        args.data_dir,
+        database,
+        bulk_load=args.bulk_load,
+        num_workers=args.num_workers,
+        database_impl=database_impl,
+        dry_run=args.test)
     commit = not args.test
+  except UploadError as e:
+    num_uploaded_rows = e.num_rows
+    raise
   finally:
-    num_inserted_rows = database.count_all_rows() - num_starting_rows
-    print('inserted=%d committed=%s' % (num_inserted_rows, str(commit)))
+    committed = commit or workers_commit
+    print('uploaded=%d committed=%s' % (num_uploaded_rows, str(committed)))
     database.disconnect(commit)
 
 
@@ -3,6 +3,14 @@
 See src/ddl/covidcast.sql for an explanation of each field.
 """
 
+# standard library
+import collections
+import csv
+import itertools
+import random
+import re
+import time
+
 # third party
 import mysql.connector
 
@@ -10,41 +18,421 @@ import mysql.connector
 import delphi.operations.secrets as secrets
 
 
+# a numeric literal, as accepted by python's `float` (excluding nan and inf)
+_SQL_NUMBER_PATTERN = r'^[-+]?([0-9]+[.]?[0-9]*|[.][0-9]+)([eE][-+]?[0-9]+)?$'
+
+# CSV values which pandas reads as missing by default (matched exactly), see
+# the `na_values` argument of `pandas.read_csv`
+_SQL_PANDAS_NA_VALUES = (
+  "('', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', "
+  "'1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', "
+  "'nan', 'null')"
+)
+
+# CSV values which, in any case, denote a missing optional value, see
+# `CsvImporter.maybe_apply`
+_SQL_NULLISH_VALUES = "('', 'na', 'nan', 'inf', '-inf', 'none')"
+
+
+def _sql_is_na(column):
+  """Return an SQL condition which checks whether pandas reads a value as NA."""
+
+  return "CAST(COALESCE(%s, '') AS BINARY) IN %s" % (
+      column, _SQL_PANDAS_NA_VALUES)
+
+
+def _sql_is_nullish(column):
+  """Return an SQL condition which checks whether a value is missing."""
+
+  return "(%s OR LOWER(COALESCE(%s, '')) IN %s)" % (
+      _sql_is_na(column), column, _SQL_NULLISH_VALUES)
+
+
+# per `geo_type`, an SQL expression which normalizes the raw `geo_id` of a
+# staged row, and an SQL condition which checks the normalized `geo_value`;
+# these mirror `CsvImporter.extract_and_check_row`
+_SQL_GEO_VALUE = {
+  'county': (
+    'LOWER(`geo_id`)',
+    "CHAR_LENGTH(%s) = 5 AND %s BETWEEN '01000' AND '80000'",
+  ),
+  'hrr': (
+    'CAST(ROUND(`geo_id`) AS CHAR)',
+    '%s + 0 BETWEEN 1 AND 500',
+  ),
+  'msa': (
+    'CAST(ROUND(`geo_id`) AS CHAR)',
+    "CHAR_LENGTH(%s) = 5 AND %s BETWEEN '10000' AND '99999'",
+  ),
+  'dma': (
+    'CAST(ROUND(`geo_id`) AS CHAR)',
+    '%s + 0 BETWEEN 450 AND 950',
+  ),
+  'state': (
+    'LOWER(`geo_id`)',
+    "CHAR_LENGTH(%s) = 2 AND %s BETWEEN 'aa' AND 'zz'",
+  ),
+}
+
+# update `covidcast` rows which already exist when they're inserted, see
+# `Database.insert_or_update_batch`
+_SQL_UPDATE_ROW = '''
+  ON DUPLICATE KEY UPDATE
+    `timestamp1` = VALUES(`timestamp1`),
+    `value` = VALUES(`value`),
+    `stderr` = VALUES(`stderr`),
+    `sample_size` = VALUES(`sample_size`)
+'''
+
+# account for upserted rows in `covidcast_series`, see `Database._update_series`
+_SQL_UPDATE_SERIES = '''
+  ON DUPLICATE KEY UPDATE
+    `max_timestamp1` = GREATEST(`max_timestamp1`, VALUES(`max_timestamp1`)),
+    `min_timestamp2` = LEAST(`min_timestamp2`, VALUES(`min_timestamp2`)),
+    `min_day` = LEAST(`min_day`, VALUES(`min_day`)),
+    `max_day` = GREATEST(`max_day`, VALUES(`max_day`)),
+    `series_length` = `series_length` + VALUES(`series_length`)
+'''
+
+# update a single row's `direction`, see `Database.update_direction`
+_SQL_UPDATE_DIRECTION = '''
+  UPDATE
+    `covidcast` USE INDEX (`ix_ts`)
+  SET
+    `timestamp2` = %s,
+    `direction` = %s
+  WHERE
+    `source` = %s AND
+    `signal` = %s AND
+    `time_type` = %s AND
+    `geo_type` = %s AND
+    `time_value` = %s AND
+    `geo_value` = %s
+'''
+
+# update a time-series' `timestamp2`, see `Database.update_timeseries_timestamp2`
+_SQL_UPDATE_TIMESERIES_TIMESTAMP2 = '''
+  UPDATE
+    `covidcast` USE INDEX (`ix_ts`)
+  SET
+    `timestamp2` = %s
+  WHERE
+    `source` = %s AND
+    `signal` = %s AND
+    `time_type` = %s AND
+    `geo_type` = %s AND
+    `geo_value` = %s
+'''
+
+# likewise, for the time-series' summary in `covidcast_series`
+_SQL_UPDATE_SERIES_TIMESTAMP2 = '''
+  UPDATE
+    `covidcast_series`
+  SET
+    `min_timestamp2` = %s
+  WHERE
+    `source` = %s AND
+    `signal` = %s AND
+    `time_type` = %s AND
+    `geo_type` = %s AND
+    `geo_value` = %s
+'''
+
+# values which may be written into SQL as literals, rather than as parameters
+_SQL_LITERAL_PATTERN = re.compile(r'^[\w.-]+$', re.ASCII)
+
+
+def _sql_literals(source, signal, time_type, geo_type, time_value):
+  """Return the values shared by the rows of a file as SQL literals.
+
+  Return None if any of the values isn't safe to use as a literal.
+  """
+
+  strings = (source, signal, time_type, geo_type)
+  for value in strings:
+    if not isinstance(value, str) or not _SQL_LITERAL_PATTERN.match(value):
+      return None
+  if not isinstance(time_value, int):
+    return None
+  return tuple("'%s'" % value for value in strings) + (str(time_value),)
+
+
+# the columns of the `covidcast` unique key, in order
+_SQL_KEY_COLUMNS = (
+  'source',
+  'signal',
+  'time_type',
+  'geo_type',
+  'time_value',
+  'geo_value',
+)
+
+# statements for a batch of rows, see `Database._insert_or_update_rows`; the
+# values of the leading key columns may be shared by all rows and given as
+# literals, so that only the values which vary between rows are sent as
+# parameters
+
+
+def _sql_select_rows(literals, num_rows):
+  """Find which of `num_rows` rows already exist."""
+
+  columns = ['`%s`' % name for name in _SQL_KEY_COLUMNS[len(literals):]]
+  conditions = [
+    '`%s` = %s' % (name, literal)
+    for name, literal in zip(_SQL_KEY_COLUMNS, literals)
+  ]
+  key = '(%s)' % ', '.join(['%s'] * len(columns))
+  conditions.append('(%s) IN (%s)' % (
+      ', '.join(columns), ', '.join([key] * num_rows)))
+
+  return '''
+    SELECT
+      %s
+    FROM
+      `covidcast`
+    WHERE
+      %s
+  ''' % (', '.join(columns), ' AND '.join(conditions))
+
+
+def _sql_insert_rows(literals, num_rows):
+  """Insert `num_rows` new rows, updating any which exist by now."""
+
+  values = list(literals) + ['%s'] * (len(_SQL_KEY_COLUMNS) - len(literals))
+  row = '(0, %s, %%s, %%s, %%s, %%s, 0, NULL)' % ', '.join(values)
+  return '''
+    INSERT INTO `covidcast` VALUES
+      %s
+  ''' % ', '.join([row] * num_rows) + _SQL_UPDATE_ROW
+
+
+def _sql_update_rows(literals, num_rows):
+  """Update `num_rows` existing rows."""
+
+  # join the existing rows to their new values, given as a derived table
+  columns = _SQL_KEY_COLUMNS[len(literals):]
+  values = '''
+    SELECT
+      %s
+  ''' % ', '.join(
+    ['%%s AS `%s`' % name for name in columns] +
+    ['%s AS `value`', '%s AS `stderr`', '%s AS `sample_size`']
+  ) + '''
+    UNION ALL SELECT %s
+  ''' % ', '.join(['%s'] * (len(columns) + 3)) * (num_rows - 1)
+
+  conditions = [
+    'c.`%s` = %s' % (name, literal)
+    for name, literal in zip(_SQL_KEY_COLUMNS, literals)
+  ]
+
+  return '''
+    UPDATE
+      `covidcast` c
+    JOIN
+      (%s) u
+    USING
+      (%s)
+    SET
+      c.`timestamp1` = %%s,
+      c.`value` = u.`value`,
+      c.`stderr` = u.`stderr`,
+      c.`sample_size` = u.`sample_size`
+    %s
+  ''' % (
+    values,
+    ', '.join('`%s`' % name for name in columns),
+    ('WHERE ' + ' AND '.join(conditions)) if conditions else '',
+  )
+
+
 class Database:
   """A collection of covidcast database operations."""
 
   DATABASE_NAME = 'epidata'
 
-  def connect(self, connector_impl=mysql.connector):
-    """Establish a connection to the database."""
+  # connections are drawn from a process-wide pool, which the connector creates
+  # on first use and which is shared by all `Database` instances
+  POOL_NAME = 'covidcast'
+  POOL_SIZE = 8
+
+  # maximum age, in seconds, of cached standard deviations before recomputing
+  STDEV_CACHE_MAX_AGE = 3600
+
+  def connect(self, connector_impl=mysql.connector, allow_local_infile=False):
+    """Establish a connection to the database.
+
+    allow_local_infile: if true, let the server read the client files named by
+      `LOAD DATA LOCAL INFILE`, which is needed only by `bulk_load_csv`
+
+    The connection is taken from a pool, so repeated connections within the
+    same process reuse an already authenticated session. Pooled connections
+    keep the settings of their pool, so connections which allow local files
+    are drawn from a separate pool.
+
+    Autocommit is disabled, so all changes made through this connection form a
+    single transaction which is committed (or rolled back) by `disconnect`.
+    This lets InnoDB flush its log once per transaction rather than once per
+    statement.
+    """
+
+    pool_name = Database.POOL_NAME
+    if allow_local_infile:
+      pool_name += '_local_infile'
 
     u, p = secrets.db.epi
     self._connection = connector_impl.connect(
+        pool_name=pool_name,
+        pool_size=Database.POOL_SIZE,
         host=secrets.db.host,
         user=u,
         password=p,
-        database=Database.DATABASE_NAME)
+        database=Database.DATABASE_NAME,
+        autocommit=False,
+        allow_local_infile=allow_local_infile)
     self._cursor = self._connection.cursor()
+    # created on first use, see `_get_prepared_cursor`
+    self._prepared_cursor = None
 
   def disconnect(self, commit):
-    """Close the database connection.
+    """Close the database connection, returning it to the pool.
 
     commit: if true, commit changes, otherwise rollback
     """
 
     self._cursor.close()
+    if self._prepared_cursor is not None:
+      self._prepared_cursor.close()
     if commit:
       self._connection.commit()
+    else:
+      self._connection.rollback()
     self._connection.close()
 
-  def count_all_rows(self):
-    """Return the total number of rows in table `covidcast`."""
+  @staticmethod
+  def is_deadlock(error):
+    """Return whether the given exception reports a deadlock.
+
+    InnoDB resolves a deadlock by rolling back one of the transactions
+    involved, which can then be retried from the start.
+    """
+
+    errno = getattr(error, 'errno', None)
+    return errno == mysql.connector.errorcode.ER_LOCK_DEADLOCK
+
+  def _get_prepared_cursor(self):
+    """Return the cursor used by per-row writes, creating it on first use.
+
+    Statements executed through this cursor are parsed once by the server, and
+    then executed repeatedly with new parameters.
+    """
+
+    if self._prepared_cursor is None:
+      self._prepared_cursor = self._connection.cursor(prepared=True)
+    return self._prepared_cursor
+
+  def _stream_cursor(self):
+    """Return a new unbuffered cursor, which reads rows as they are consumed."""
+
+    return self._connection.cursor(buffered=False)
+
+  @staticmethod
+  def _fetch_rows(cursor, size=10000):
+    """Yield each row of an executed `cursor`, fetching `size` rows at a time.
+
+    Fetching many rows per call lets the connector's C extension read and
+    convert them in bulk, rather than making one call per row.
+    """
 
-    self._cursor.execute('SELECT count(1) FROM `covidcast`')
+    while True:
+      rows = cursor.fetchmany(size)
+      if not rows:
+        return
+      yield from rows
+
+  @staticmethod
+  def _stream_rows(cursor):
+    """Yield each row of an executed `cursor`, and then close the cursor.
+
+    The result set must be fully consumed before another query is issued on
+    the same connection.
+    """
+
+    try:
+      yield from Database._fetch_rows(cursor)
+    finally:
+      cursor.close()
+
+  def count_all_rows(self, exact=False):
+    """Return the total number of rows in table `covidcast`.
+
+    exact: if true, count the rows, which requires a full scan of the table,
+      otherwise return InnoDB's row count estimate, which is approximate and
+      may be cached by the server (see `information_schema_stats_expiry`)
+    """
+
+    if exact:
+      self._cursor.execute('SELECT count(1) FROM `covidcast`')
+    else:
+      sql = '''
+        SELECT
+          `table_rows`
+        FROM
+          `information_schema`.`tables`
+        WHERE
+          `table_schema` = %s AND
+          `table_name` = 'covidcast'
+      '''
+      self._cursor.execute(sql, (Database.DATABASE_NAME,))
 
     for (num,) in self._cursor:
       return num
 
+  def _update_series(self, rows, timestamp, existing):
+    """Account for rows which are about to be upserted in `covidcast_series`.
+
+    `rows`: a sequence of tuples, each having the same nine values (in the same
+      order) as the arguments of `insert_or_update`
+    `timestamp`: the primary timestamp with which the rows will be upserted
+    `existing`: the set of unique keys, among the given rows, which already
+      exist
+
+    This must be called before the rows are upserted into `covidcast`, so that
+    rows which extend their time-series can be told apart from rows which
+    update an existing day.
+    """
+
+    # summarize the rows of each time-series
+    series = {}
+    for row in rows:
+      key = tuple(row[:4]) + (row[5],)
+      time_value = row[4]
+      is_new = 0 if tuple(row[:6]) in existing else 1
+      if key in series:
+        min_day, max_day, num_new = series[key]
+        min_day, max_day = min(min_day, time_value), max(max_day, time_value)
+        series[key] = (min_day, max_day, num_new + is_new)
+      else:
+        series[key] = (time_value, time_value, is_new)
+
+    # upserted rows get a new primary timestamp, so that their directions (and
+    # those of the following days) become stale; a secondary timestamp of zero
+    # marks the time-series as such, whether or not it already has a summary
+    # rows are upserted in key order, so that concurrent transactions lock them
+    # in the same order, which makes deadlocks less likely
+    values = []
+    for key, (min_day, max_day, num_new) in sorted(series.items()):
+      values.append(key + (timestamp, 0, min_day, max_day, num_new))
+
+    sql = '''
+      INSERT INTO `covidcast_series` VALUES
+        %s
+    ''' % ', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'] * len(values))
+
+    args = tuple(value for row in values for value in row)
+
+    self._cursor.execute(sql + _SQL_UPDATE_SERIES, args)
+
   def insert_or_update(
       self,
       source,
@@ -59,20 +447,14 @@ class Database:
     """
     Insert a new row, or update an existing row, in the `covidcast` table.
 
+    This is `insert_or_update_batch` for a single row, which takes three round
+    trips to the database (see `_update_series`), so callers with more than a
+    few rows should use `insert_or_update_batch` instead.
+
     This has the intentional side effect of updating the primary timestamp.
     """
 
-    sql = '''
-      INSERT INTO `covidcast` VALUES
-        (0, %s, %s, %s, %s, %s, %s, UNIX_TIMESTAMP(NOW()), %s, %s, %s, 0, NULL)
-      ON DUPLICATE KEY UPDATE
-        `timestamp1` = VALUES(`timestamp1`),
-        `value` = VALUES(`value`),
-        `stderr` = VALUES(`stderr`),
-        `sample_size` = VALUES(`sample_size`)
-    '''
-
-    args = (
+    row = (
       source,
       signal,
       time_type,
@@ -83,13 +465,321 @@ class Database:
       stderr,
       sample_size,
     )
+    self.insert_or_update_batch([row])
 
-    self._cursor.execute(sql, args)
+  def insert_or_update_many(self, args_list):
+    """
+    Insert new rows, or update existing rows, in the `covidcast` table.
+
+    `args_list`: a sequence of tuples, each having the same nine values (in the
+      same order) as the arguments of `insert_or_update`
 
-  def get_data_stdev_across_locations(self):
+    This is equivalent to `insert_or_update_batch` with its default batch size.
+
+    This has the intentional side effect of updating the primary timestamp.
     """
-    Return the standard deviation of the data over all locations, for all
-    (source, signal, geo_type) tuples.
+
+    self.insert_or_update_batch(args_list)
+
+  def _insert_or_update_rows(self, rows, batch_size, prefix=(), literals=()):
+    """Insert new rows, or update existing rows, in the `covidcast` table.
+
+    `rows`: a sequence of tuples, each having the values of the arguments of
+      `insert_or_update` which follow those in `prefix`
+    `batch_size`: the maximum number of rows sent in a single statement
+    `prefix`: the values of the leading key columns, shared by all rows
+    `literals`: `prefix` as SQL literals (see `_sql_literals`), or empty to
+      send the shared values as parameters
+    """
+
+    timestamp = int(time.time())
+    num_shared = len(prefix)
+    num_key_values = len(_SQL_KEY_COLUMNS) - num_shared
+    rows = list(rows)
+    for start in range(0, len(rows), batch_size):
+      # if a row is given more than once, only the last one is kept
+      batch = collections.OrderedDict()
+      for row in rows[start:start + batch_size]:
+        batch[tuple(row[:num_key_values])] = tuple(row)
+
+      # find which rows already exist, and account for all of them in
+      # `covidcast_series` before they're upserted
+      sql = _sql_select_rows(literals, len(batch))
+      args = tuple(value for key in batch.keys() for value in key)
+      self._cursor.execute(sql, args)
+      existing = set(tuple(row) for row in self._cursor)
+
+      self._update_series(
+          [prefix + row for row in batch.values()],
+          timestamp,
+          set(prefix + key for key in existing))
+      new_rows = [row for key, row in batch.items() if key not in existing]
+      old_rows = [row for key, row in batch.items() if key in existing]
+
+      if new_rows:
+        sql = _sql_insert_rows(literals, len(new_rows))
+        args = tuple(
+          value
+          for row in new_rows
+          for value in (
+            row[:num_key_values] + (timestamp,) + row[num_key_values:])
+        )
+        self._cursor.execute(sql, args)
+
+      if old_rows:
+        sql = _sql_update_rows(literals, len(old_rows))
+        args = tuple(value for row in old_rows for value in row)
+        args += (timestamp,)
+        self._cursor.execute(sql, args)
+
+  def insert_or_update_batch(self, rows, batch_size=1000):
+    """
+    Insert new rows, or update existing rows, in the `covidcast` table.
+
+    `rows`: a sequence of tuples, each having the same nine values (in the same
+      order) as the arguments of `insert_or_update`
+    `batch_size`: the maximum number of rows sent in a single statement
+
+    Rows are written with multi-row statements per batch, rather than one
+    statement per row, which greatly reduces the number of round trips to the
+    database. Within each batch, rows which don't yet exist (typically most of
+    them) are written with an INSERT, and the others with an UPDATE, so that
+    rows which are known to exist don't take the slower path of an INSERT
+    which fails on a duplicate key and then updates the existing row instead.
+    New rows are looked up with a non-locking read, so they may have been
+    inserted since by another transaction, in which case they're updated.
+
+    This has the intentional side effect of updating the primary timestamp,
+    which is the same for all rows.
+    """
+
+    self._insert_or_update_rows(rows, batch_size)
+
+  def insert_or_update_file(
+      self,
+      source,
+      signal,
+      time_type,
+      geo_type,
+      time_value,
+      rows,
+      batch_size=1000):
+    """
+    Insert new rows, or update existing rows, in the `covidcast` table, where
+    all rows share the same source, signal, time type, geo type, and time value
+    (as do the rows of a single CSV file).
+
+    `rows`: a sequence of (geo_value, value, stderr, sample_size) tuples
+    `batch_size`: the maximum number of rows sent in a single statement
+
+    This behaves like `insert_or_update_batch`, except that the shared values
+    are written into the statements as literals, so that only the values which
+    vary between rows are sent as parameters. If any of the shared values isn't
+    safe to use as a literal, this falls back to `insert_or_update_batch`.
+    """
+
+    prefix = (source, signal, time_type, geo_type, time_value)
+    literals = _sql_literals(*prefix)
+    if literals is None:
+      self.insert_or_update_batch(
+          [prefix + tuple(row) for row in rows], batch_size=batch_size)
+      return
+
+    self._insert_or_update_rows(
+        rows, batch_size, prefix=prefix, literals=literals)
+
+  def bulk_load_csv(
+      self, path, source, signal, time_type, geo_type, time_value):
+    """
+    Insert new rows, or update existing rows, in the `covidcast` table from
+    the given CSV file, using `LOAD DATA LOCAL INFILE`.
+
+    The file is parsed by the database server into a temporary staging table,
+    from which all valid rows are upserted with a single statement. Validation
+    follows `CsvImporter.load_csv`, but is done in SQL.
+
+    Return a tuple of whether the header and all rows of the file are valid,
+    and the number of (valid) rows which were upserted.
+
+    The connection must have been opened with `allow_local_infile`.
+
+    This has the intentional side effect of updating the primary timestamp.
+    """
+
+    # map CSV columns, by name, onto the staging table
+    with open(path, newline='') as f:
+      first_line = f.readline()
+    header = [name.strip() for name in next(csv.reader([first_line]), [])]
+    staging_columns = ('geo_id', 'val', 'se', 'sample_size')
+    if not set(header) >= set(staging_columns):
+      return (False, 0)
+    variables = [
+      ('`%s`' % name) if name in staging_columns else '@unused'
+      for name in header
+    ]
+
+    # a temporary table is private to the session, and (unlike `TRUNCATE`)
+    # creating and clearing it doesn't implicitly commit the transaction
+    self._cursor.execute('''
+      CREATE TEMPORARY TABLE IF NOT EXISTS `covidcast_load_staging` (
+        `geo_id` varchar(64),
+        `val` varchar(64),
+        `se` varchar(64),
+        `sample_size` varchar(64)
+      )
+    ''')
+    self._cursor.execute('DELETE FROM `covidcast_load_staging`')
+
+    # lines are assumed to end like the header does, so that a carriage return
+    # isn't loaded as part of the last column
+    if first_line.endswith('\r\n'):
+      line_terminator = '\\r\\n'
+    else:
+      line_terminator = '\\n'
+
+    sql = '''
+      LOAD DATA LOCAL INFILE %%s
+      INTO TABLE `covidcast_load_staging`
+      FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"'
+      LINES TERMINATED BY '%s'
+      IGNORE 1 LINES
+      (%s)
+    ''' % (line_terminator, ', '.join(variables))
+
+    self._cursor.execute(sql, (path,))
+
+    # build the normalization and validation expressions for this file
+    geo_value, geo_check = _SQL_GEO_VALUE[geo_type]
+    is_number = "%%s REGEXP '%s'" % _SQL_NUMBER_PATTERN
+    stderr = 'IF(%s, NULL, `se` + 0)' % _sql_is_nullish('`se`')
+    sample_size = (
+      'IF(%s, NULL, `sample_size` + 0)' % _sql_is_nullish('`sample_size`'))
+    conditions = [
+      'NOT %s' % _sql_is_na('`geo_id`'),
+      geo_check.replace('%s', geo_value),
+      is_number % '`val`',
+      '(%s OR (%s AND `se` + 0 >= 0))' % (
+        _sql_is_nullish('`se`'),
+        is_number % '`se`',
+      ),
+      '(%s OR (%s AND `sample_size` + 0 >= 5))' % (
+        _sql_is_nullish('`sample_size`'),
+        is_number % '`sample_size`',
+      ),
+    ]
+    if geo_type in ('hrr', 'msa', 'dma'):
+      # these ids must be (possibly float-formatted) integers
+      conditions.insert(1, is_number % '`geo_id`')
+      conditions.insert(2, '`geo_id` + 0 = ROUND(`geo_id`)')
+    is_valid = 'COALESCE(%s, FALSE)' % ' AND '.join(conditions)
+
+    self._cursor.execute('''
+      SELECT
+        COALESCE(SUM(%s), 0),
+        COALESCE(SUM(NOT %s), 0)
+      FROM
+        `covidcast_load_staging`
+    ''' % (is_valid, is_valid))
+    num_valid, num_invalid = 0, 0
+    for (num_valid, num_invalid) in self._cursor:
+      pass
+    all_rows_valid = num_invalid == 0
+
+    timestamp = int(time.time())
+
+    # account for the valid rows in `covidcast_series`, see `_update_series`;
+    # a geo value given more than once (possibly before normalization) only
+    # adds one row to its time-series
+    sql = '''
+      INSERT INTO `covidcast_series`
+      SELECT
+        %%s, %%s, %%s, %%s, s.`geo_value`, %%s,
+        0, %%s, %%s, IF(c.`id` IS NULL, 1, 0)
+      FROM
+        (
+          SELECT DISTINCT
+            %s AS `geo_value`
+          FROM
+            `covidcast_load_staging`
+          WHERE
+            %s
+        ) s
+      LEFT JOIN
+        `covidcast` c
+      ON
+        c.`source` = %%s AND
+        c.`signal` = %%s AND
+        c.`time_type` = %%s AND
+        c.`geo_type` = %%s AND
+        c.`time_value` = %%s AND
+        c.`geo_value` = s.`geo_value`
+      ORDER BY
+        s.`geo_value`
+    ''' % (geo_value, is_valid)
+
+    args = (
+      source,
+      signal,
+      time_type,
+      geo_type,
+      timestamp,
+      time_value,
+      time_value,
+      source,
+      signal,
+      time_type,
+      geo_type,
+      time_value,
+    )
+
+    self._cursor.execute(sql + _SQL_UPDATE_SERIES, args)
+
+    sql = '''
+      INSERT INTO `covidcast` (
+        `id`,
+        `source`,
+        `signal`,
+        `time_type`,
+        `geo_type`,
+        `time_value`,
+        `geo_value`,
+        `timestamp1`,
+        `value`,
+        `stderr`,
+        `sample_size`,
+        `timestamp2`,
+        `direction`
+      )
+      SELECT
+        0, %%s, %%s, %%s, %%s, %%s, %s, %%s, `val` + 0, %s, %s, 0, NULL
+      FROM
+        `covidcast_load_staging`
+      WHERE
+        %s
+    ''' % (geo_value, stderr, sample_size, is_valid)
+
+    args = (
+      source,
+      signal,
+      time_type,
+      geo_type,
+      time_value,
+      timestamp,
+    )
+
+    self._cursor.execute(sql + _SQL_UPDATE_ROW, args)
+    self._cursor.execute('DELETE FROM `covidcast_load_staging`')
+
+    return (all_rows_valid, int(num_valid))
+
+  def refresh_stdev_cache(self):
+    """Recompute the `covidcast_stdev_cache` table from `covidcast`.
+
+    The standard deviations are computed with a plain (non-locking) SELECT,
+    rather than with `INSERT ... SELECT`, which would lock every `covidcast`
+    row it reads until the end of the transaction, and so block uploads.
+
+    Return the recomputed (source, signal, geo_type, aggregate_stdev) rows.
     """
 
     sql = '''
@@ -109,54 +799,140 @@ class Database:
     '''
 
     self._cursor.execute(sql)
-    return list(self._cursor)
+    rows = sorted(tuple(row) for row in self._cursor)
 
-  def get_rows_with_stale_direction(self):
-    """Return rows in the `covidcast` table where `direction` is stale.
+    if rows:
+      sql = '''
+        INSERT INTO `covidcast_stdev_cache`
+          (`source`, `signal`, `geo_type`, `aggregate_stdev`, `timestamp`)
+        VALUES
+          %s
+        ON DUPLICATE KEY UPDATE
+          `aggregate_stdev` = VALUES(`aggregate_stdev`),
+          `timestamp` = VALUES(`timestamp`)
+      ''' % ', '.join(['(%s, %s, %s, %s, %s)'] * len(rows))
 
-    Note that this is limited to `time_type` of 'day' as direction is not yet
-    defined at other time scales.
+      timestamp = int(time.time())
+      args = tuple(value for row in rows for value in row + (timestamp,))
 
-    To avoid runaway resource usage, the result set is limited to 10,000 rows.
-    Rows are intentionally returned in random order promote update equity among
-    the various data sources and geographic locations.
+      self._cursor.execute(sql, args)
+
+    return rows
+
+  def get_data_stdev_across_locations(self, max_age=STDEV_CACHE_MAX_AGE):
+    """
+    Return the standard deviation of the data over all locations, for all
+    (source, signal, geo_type) tuples.
+
+    Values are read from `covidcast_stdev_cache`. If the cache was not
+    refreshed within the last `max_age` seconds, the values are instead
+    computed from `covidcast`, and the cache is refreshed with them.
     """
 
     sql = '''
       SELECT
-        c.`source`,
-        c.`signal`,
-        c.`time_type`,
-        c.`geo_type`,
-        c.`time_value`,
-        c.`geo_value`,
-        c.`timestamp2`,
-        MAX(d.`timestamp1`) AS `max_timestamp1`,
-        count(1) AS `support`
+        `source`,
+        `signal`,
+        `geo_type`,
+        `aggregate_stdev`
       FROM
-        `covidcast` c JOIN `covidcast` d
-      USING
-        (`source`, `signal`, `time_type`, `geo_type`, `geo_value`)
+        `covidcast_stdev_cache`
       WHERE
-        c.`time_type` = 'day' AND
-        DATEDIFF(c.`time_value`, d.`time_value`) BETWEEN 0 AND 6
-      GROUP BY
-        c.`source`,
-        c.`signal`,
-        c.`time_type`,
-        c.`geo_type`,
-        c.`time_value`,
-        c.`geo_value`
-      HAVING
-        MAX(d.`timestamp1`) > c.`timestamp2`
-      ORDER BY
-        rand()
-      LIMIT
-        10000
+        `timestamp` >= %s
     '''
 
-    self._cursor.execute(sql)
-    return list(self._cursor)
+    self._cursor.execute(sql, (int(time.time()) - max_age,))
+    rows = list(self._cursor)
+
+    if not rows:
+      rows = self.refresh_stdev_cache()
+
+    return rows
+
+  def get_rows_with_stale_direction(self):
+    """Return rows in the `covidcast` table where `direction` is stale.
+
+    Note that this is limited to `time_type` of 'day' as direction is not yet
+    defined at other time scales.
+
+    To avoid runaway resource usage, the result set is limited to 10,000 rows.
+    Rows are drawn from time-series chosen in random order to promote update
+    equity among the various data sources and geographic locations. The random
+    choice is made here, over the (comparatively few) keys of potentially stale
+    time-series, rather than by having the database sort every candidate row.
+    Since only some rows of a time-series may be stale, time-series are read in
+    batches, each just long enough to cover the rows which are still needed,
+    until the limit is reached or no time-series remain.
+
+    The 7-day trailing window of each row is computed with a window function,
+    which requires MySQL 8.0 (or MariaDB 10.2) or later.
+
+    Rows are streamed from the database as they are consumed, and the result
+    must be fully consumed before issuing another query.
+    """
+
+    # choose random time-series until they could cover the remaining rows
+    limit = 10000
+    stale_keys = list(self.get_keys_with_potentially_stale_direction())
+    random.shuffle(stale_keys)
+    while stale_keys and limit > 0:
+      sampled_keys = []
+      num_rows = 0
+      while stale_keys and num_rows < limit:
+        key = stale_keys.pop()
+        sampled_keys.append(key[:4])
+        num_rows += key[-1]
+
+      # the trailing window covers the current day and the 6 days before it
+      sql = '''
+        SELECT
+          `source`,
+          `signal`,
+          `time_type`,
+          `geo_type`,
+          `time_value`,
+          `geo_value`,
+          `timestamp2`,
+          `max_timestamp1`,
+          `support`
+        FROM
+          (
+            SELECT
+              `source`,
+              `signal`,
+              `time_type`,
+              `geo_type`,
+              `time_value`,
+              `geo_value`,
+              `timestamp2`,
+              MAX(`timestamp1`) OVER w AS `max_timestamp1`,
+              COUNT(1) OVER w AS `support`
+            FROM
+              `covidcast` USE INDEX (`ix_ts`)
+            WHERE
+              (`source`, `signal`, `time_type`, `geo_type`, `geo_value`) IN (%s)
+            WINDOW w AS (
+              PARTITION BY `source`, `signal`, `geo_type`, `geo_value`
+              ORDER BY TO_DAYS(`time_value`)
+              RANGE BETWEEN 6 PRECEDING AND CURRENT ROW
+            )
+          ) t
+        WHERE
+          `max_timestamp1` > `timestamp2`
+        LIMIT
+          %d
+      ''' % (
+        ', '.join(["(%s, %s, 'day', %s, %s)"] * len(sampled_keys)),
+        limit,
+      )
+
+      args = tuple(value for key in sampled_keys for value in key)
+
+      cursor = self._stream_cursor()
+      cursor.execute(sql, args)
+      for row in Database._stream_rows(cursor):
+        limit -= 1
+        yield row
 
   def get_rows_to_compute_direction(
       self,
@@ -172,7 +948,7 @@ class Database:
         DATEDIFF(`time_value`, %s) AS `time_offset`,
         `value`
       FROM
-        `covidcast`
+        `covidcast` USE INDEX (`ix_ts`)
       WHERE
         `source` = %s AND
         `signal` = %s AND
@@ -194,7 +970,7 @@ class Database:
     )
 
     self._cursor.execute(sql, args)
-    return list(self._cursor)
+    return self._cursor.fetchall()
 
   def update_direction(
       self,
@@ -211,22 +987,8 @@ class Database:
     This has the intentional side effect of updating the secondary timestamp.
     """
 
-    sql = '''
-      UPDATE
-        `covidcast`
-      SET
-        `timestamp2` = UNIX_TIMESTAMP(NOW()),
-        `direction` = %s
-      WHERE
-        `source` = %s AND
-        `signal` = %s AND
-        `time_type` = %s AND
-        `geo_type` = %s AND
-        `time_value` = %s AND
-        `geo_value` = %s
-    '''
-
     args = (
+      int(time.time()),
       direction,
       source,
       signal,
@@ -236,7 +998,49 @@ class Database:
       geo_value,
     )
 
-    self._cursor.execute(sql, args)
+    self._get_prepared_cursor().execute(_SQL_UPDATE_DIRECTION, args)
+
+  def update_direction_batch(self, rows, batch_size=1000):
+    """
+    Update the `direction` column for many rows in the `covidcast` table.
+
+    `rows`: a sequence of tuples, each having the same seven values (in the
+      same order) as the arguments of `update_direction`
+    `batch_size`: the maximum number of rows updated by one statement
+
+    Rows are updated with one UPDATE per distinct `direction` value (of which
+    there are only a few) in each batch, finding rows through the unique key.
+
+    This has the intentional side effect of updating the secondary timestamp,
+    which is the same for all rows.
+    """
+
+    timestamp = int(time.time())
+    rows = list(rows)
+    for start in range(0, len(rows), batch_size):
+      # group the keys of rows by their new direction
+      keys_by_direction = collections.OrderedDict()
+      for row in rows[start:start + batch_size]:
+        keys_by_direction.setdefault(row[6], []).append(row[:6])
+
+      for direction, keys in keys_by_direction.items():
+        key_list = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(keys))
+
+        sql = '''
+          UPDATE
+            `covidcast`
+          SET
+            `timestamp2` = %%s,
+            `direction` = %%s
+          WHERE
+            (`source`, `signal`, `time_type`, `geo_type`, `time_value`,
+              `geo_value`) IN (%s)
+        ''' % key_list
+
+        args = (timestamp, direction)
+        args += tuple(value for key in keys for value in key)
+
+        self._cursor.execute(sql, args)
 
   def get_keys_with_potentially_stale_direction(self):
     """
@@ -245,6 +1049,12 @@ class Database:
 
     Note that this is limited to `time_type` of 'day' as direction is not yet
     defined at other time scales.
+
+    Time-series are read from the `covidcast_series` summary, rather than by
+    aggregating all of `covidcast`.
+
+    The result is an iterator over rows of the cursor, which must be fully
+    consumed before issuing another query.
     """
 
     sql = '''
@@ -253,31 +1063,64 @@ class Database:
         `signal`,
         `geo_type`,
         `geo_value`,
-        MAX(`timestamp1`) AS `max_timestamp1`,
-        MIN(`timestamp2`) AS `min_timestamp2`,
-        MIN(`time_value`) AS `min_day`,
-        MAX(`time_value`) AS `max_day`,
-        COUNT(1) AS `series_length`
+        `max_timestamp1`,
+        `min_timestamp2`,
+        `min_day`,
+        `max_day`,
+        `series_length`
       FROM
-        `covidcast`
+        `covidcast_series`
       WHERE
-        `time_type` = 'day'
+        `time_type` = 'day' AND
+        `max_timestamp1` > `min_timestamp2`
+    '''
+
+    self._cursor.execute(sql)
+    return Database._fetch_rows(self._cursor)
+
+  def rebuild_series(self):
+    """Recompute the `covidcast_series` table from `covidcast`.
+
+    The summary is kept up to date by the methods of this class which upsert
+    rows, so this is only needed to populate a newly created summary table,
+    and when `covidcast` is modified by other means (see
+    `covidcast_series_builder`).
+    """
+
+    self._cursor.execute('DELETE FROM `covidcast_series`')
+
+    sql = '''
+      INSERT INTO `covidcast_series`
+      SELECT
+        `source`,
+        `signal`,
+        `time_type`,
+        `geo_type`,
+        `geo_value`,
+        MAX(`timestamp1`),
+        MIN(`timestamp2`),
+        MIN(`time_value`),
+        MAX(`time_value`),
+        COUNT(1)
+      FROM
+        `covidcast`
       GROUP BY
         `source`,
         `signal`,
         `time_type`,
         `geo_type`,
         `geo_value`
-      HAVING
-        MAX(`timestamp1`) > MIN(`timestamp2`)
     '''
 
     self._cursor.execute(sql)
-    return list(self._cursor)
 
   def get_daily_timeseries_for_direction_update(
       self, source, signal, geo_type, geo_value, min_day, max_day):
-    """Return the indicated `covidcast` time-series, including timestamps."""
+    """Return the indicated `covidcast` time-series, including timestamps.
+
+    Rows are streamed from the database as they are consumed, and the result
+    must be fully consumed before issuing another query.
+    """
 
     sql = '''
       SELECT
@@ -287,7 +1130,7 @@ class Database:
         `timestamp1`,
         `timestamp2`
       FROM
-        `covidcast`
+        `covidcast` USE INDEX (`ix_ts`)
       WHERE
         `source` = %s AND
         `signal` = %s AND
@@ -309,8 +1152,80 @@ class Database:
       max_day,
     )
 
-    self._cursor.execute(sql, args)
-    return list(self._cursor)
+    cursor = self._stream_cursor()
+    cursor.execute(sql, args)
+    return Database._stream_rows(cursor)
+
+  def get_all_stale_timeseries(self, keys=None, batch_size=100):
+    """
+    Yield every `covidcast` time-series for which all `direction` values can
+    not be guaranteed to be fresh, along with the data needed to update them.
+
+    `keys`: a sequence of rows as returned by
+      `get_keys_with_potentially_stale_direction`, or None to get them here
+    `batch_size`: the maximum number of time-series read by one query
+
+    This is equivalent to calling `get_daily_timeseries_for_direction_update`
+    for each key, but it takes one query per batch of time-series instead of
+    one query per time-series. Only one batch is held in memory at a time.
+
+    Each item is a `(key, rows)` pair, where `key` is one of `keys`, and `rows`
+    is the time-series as returned by
+    `get_daily_timeseries_for_direction_update`. Each batch is read in full
+    before its items are yielded, so other queries may be issued in between.
+    """
+
+    if keys is None:
+      keys = list(self.get_keys_with_potentially_stale_direction())
+    else:
+      keys = list(keys)
+
+    for start in range(0, len(keys), batch_size):
+      batch = keys[start:start + batch_size]
+
+      sql = '''
+        SELECT
+          k.`source`,
+          k.`signal`,
+          k.`geo_type`,
+          k.`geo_value`,
+          k.`max_timestamp1`,
+          k.`min_timestamp2`,
+          k.`min_day`,
+          k.`max_day`,
+          k.`series_length`,
+          DATEDIFF(c.`time_value`, k.`min_day`) AS `offset`,
+          c.`time_value` AS `day`,
+          c.`value`,
+          c.`timestamp1`,
+          c.`timestamp2`
+        FROM
+          `covidcast_series` k
+        JOIN
+          `covidcast` c USE INDEX (`ix_ts`)
+        USING
+          (`source`, `signal`, `time_type`, `geo_type`, `geo_value`)
+        WHERE
+          (k.`source`, k.`signal`, k.`time_type`, k.`geo_type`,
+            k.`geo_value`) IN (%s)
+        ORDER BY
+          k.`source`,
+          k.`signal`,
+          k.`geo_type`,
+          k.`geo_value`,
+          c.`time_value` ASC
+      ''' % ', '.join(["(%s, %s, 'day', %s, %s)"] * len(batch))
+
+      args = tuple(value for key in batch for value in key[:4])
+
+      self._cursor.execute(sql, args)
+
+      # group rows by time-series as they are read from the cursor
+      stale_series = []
+      all_rows = Database._fetch_rows(self._cursor)
+      for key, rows in itertools.groupby(all_rows, lambda row: row[:9]):
+        stale_series.append((key, [row[9:] for row in rows]))
+      yield from stale_series
 
   def update_timeseries_timestamp2(
       self, source, signal, time_type, geo_type, geo_value):
@@ -324,20 +1239,8 @@ class Database:
     This has no meaningful implication for non-daily time-series.
     """
 
-    sql = '''
-      UPDATE
-        `covidcast`
-      SET
-        `timestamp2` = UNIX_TIMESTAMP(NOW())
-      WHERE
-        `source` = %s AND
-        `signal` = %s AND
-        `time_type` = %s AND
-        `geo_type` = %s AND
-        `geo_value` = %s
-    '''
-
     args = (
+      int(time.time()),
       source,
       signal,
       time_type,
@@ -345,7 +1248,52 @@ class Database:
       geo_value,
     )
 
-    self._cursor.execute(sql, args)
+    self._get_prepared_cursor().execute(_SQL_UPDATE_TIMESERIES_TIMESTAMP2, args)
+    # a prepared cursor only keeps its last statement, so the summary is
+    # updated through the regular cursor rather than re-preparing both
+    self._cursor.execute(_SQL_UPDATE_SERIES_TIMESTAMP2, args)
+
+  def update_timeseries_timestamp2_batch(self, keys, batch_size=1000):
+    """Update the `timestamp2` column for many entire time-series.
+
+    `keys`: a sequence of tuples, each having the same five values (in the same
+      order) as the arguments of `update_timeseries_timestamp2`
+    `batch_size`: the maximum number of time-series updated by one statement
+
+    See `update_timeseries_timestamp2` for the meaning of this update. All
+    time-series are given the same timestamp.
+    """
+
+    timestamp = int(time.time())
+    keys = list(keys)
+    for start in range(0, len(keys), batch_size):
+      batch = keys[start:start + batch_size]
+
+      key_list = ', '.join(['(%s, %s, %s, %s, %s)'] * len(batch))
+
+      sql = '''
+        UPDATE
+          `covidcast` USE INDEX (`ix_ts`)
+        SET
+          `timestamp2` = %%s
+        WHERE
+          (`source`, `signal`, `time_type`, `geo_type`, `geo_value`) IN (%s)
+      ''' % key_list
+
+      args = (timestamp,) + tuple(value for key in batch for value in key)
+
+      self._cursor.execute(sql, args)
+
+      sql = '''
+        UPDATE
+          `covidcast_series`
+        SET
+          `min_timestamp2` = %%s
+        WHERE
+          (`source`, `signal`, `time_type`, `geo_type`, `geo_value`) IN (%s)
+      ''' % key_list
+
+      self._cursor.execute(sql, args)
 
   def update_covidcast_meta_cache(self, epidata_json):
     """Updates the `covidcast_meta_cache` table."""
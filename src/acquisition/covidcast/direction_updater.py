@@ -14,6 +14,11 @@ from delphi.epidata.acquisition.covidcast.database import Database
 from delphi.epidata.acquisition.covidcast.direction import Direction
 
 
+# number of buffered updates (of either kind) which triggers a write to the
+# database
+DIRECTION_BATCH_SIZE = 1000
+
+
 def get_argument_parser():
   """Define command line arguments."""
 
@@ -25,22 +30,14 @@ def get_argument_parser():
   return parser
 
 
-def update_loop(database, direction_impl=Direction):
-  """Find and update rows with a stale `direction` value.
+def get_data_stdevs(database, max_age=Database.STDEV_CACHE_MAX_AGE):
+  """Return a nested dict of data stdev by source, signal, and geo_type.
 
   `database`: an open connection to the epidata database
+  `max_age`: maximum age, in seconds, of cached values
   """
 
-  stale_series = database.get_keys_with_potentially_stale_direction()
-  num_series = len(stale_series)
-  num_rows = 0
-  for row in stale_series:
-    num_rows += row[-1]
-  msg = 'found %d time-series (%d rows) which may have stale direction'
-  print(msg % (num_series, num_rows))
-
-  # get the scaling factor (data stdev) for all signals and resolutions
-  rows = database.get_data_stdev_across_locations()
+  rows = database.get_data_stdev_across_locations(max_age=max_age)
   data_stdevs = {}
   for (source, signal, geo_type, aggregate_stdev) in rows:
     if source not in data_stdevs:
@@ -48,8 +45,46 @@ def update_loop(database, direction_impl=Direction):
     if signal not in data_stdevs[source]:
       data_stdevs[source][signal] = {}
     data_stdevs[source][signal][geo_type] = aggregate_stdev
+  return data_stdevs
+
+
+def update_loop(
+    database,
+    direction_impl=Direction,
+    batch_size=DIRECTION_BATCH_SIZE):
+  """Find and update rows with a stale `direction` value.
+
+  `database`: an open connection to the epidata database
+  `batch_size`: number of buffered updates (of either kind) which triggers a
+    write to the database
+  """
+
+  stale_keys = list(database.get_keys_with_potentially_stale_direction())
+  num_series = len(stale_keys)
+  num_rows = 0
+  for key in stale_keys:
+    num_rows += key[-1]
+  msg = 'found %d time-series (%d rows) which may have stale direction'
+  print(msg % (num_series, num_rows))
 
-  for ts_index, row in enumerate(stale_series):
+  # get the scaling factor (data stdev) for all signals and resolutions
+  data_stdevs = get_data_stdevs(database)
+
+  # the cache may predate a newly added signal, in which case refresh it
+  for key in stale_keys:
+    (source, signal, geo_type) = key[:3]
+    if geo_type not in data_stdevs.get(source, {}).get(signal, {}):
+      data_stdevs = get_data_stdevs(database, max_age=0)
+      break
+
+  # direction updates, and time-series to be marked fresh, are buffered and
+  # written to the database in batches
+  pending_updates = []
+  pending_fresh_keys = []
+
+  # time-series are read in batches, interleaved with the updates below
+  stale_series = database.get_all_stale_timeseries(stale_keys)
+  for ts_index, (key, timeseries_rows) in enumerate(stale_series):
     (
       source,
       signal,
@@ -60,7 +95,7 @@ def update_loop(database, direction_impl=Direction):
       min_day,
       max_day,
       series_length,
-    ) = row
+    ) = key
 
     # progress reporting for anyone debugging/watching the output
     be_verbose = ts_index < 100
@@ -83,9 +118,6 @@ def update_loop(database, direction_impl=Direction):
       )
       print(msg % args)
 
-    timeseries_rows = database.get_daily_timeseries_for_direction_update(
-        source, signal, geo_type, geo_value, min_day, max_day)
-
     # transpose result set and cast data types
     data = np.array(timeseries_rows)
     offsets, days, values, timestamp1s, timestamp2s = data.T
@@ -105,12 +137,23 @@ def update_loop(database, direction_impl=Direction):
 
     # update database
     for (day, direction) in zip(days, directions):
-      database.update_direction(
-          source, signal, 'day', geo_type, day, geo_value, direction)
+      pending_updates.append(
+          (source, signal, 'day', geo_type, day, geo_value, direction))
+    if len(pending_updates) >= batch_size:
+      database.update_direction_batch(pending_updates)
+      pending_updates = []
 
     # mark entire time-series as fresh with respect to direction
-    database.update_timeseries_timestamp2(
-        source, signal, 'day', geo_type, geo_value)
+    pending_fresh_keys.append((source, signal, 'day', geo_type, geo_value))
+    if len(pending_fresh_keys) >= batch_size:
+      database.update_timeseries_timestamp2_batch(pending_fresh_keys)
+      pending_fresh_keys = []
+
+  # write any remaining updates
+  if pending_updates:
+    database.update_direction_batch(pending_updates)
+  if pending_fresh_keys:
+    database.update_timeseries_timestamp2_batch(pending_fresh_keys)
 
 
 def main(
@@ -8,6 +8,14 @@ Delphi's COVID-19 surveillance streams.
 
 Data is public.
 
+Queries refer to the time-series index by name (`ix_ts`, see below). On a
+database where this table was created before the index was named, the index
+has an automatically generated name (e.g. `source_2`, see `SHOW INDEX FROM
+covidcast`), and must be renamed once, before deploying the acquisition code,
+by running:
+
+  ALTER TABLE covidcast RENAME INDEX source_2 TO ix_ts;
+
 +-------------+-------------+------+-----+---------+----------------+
 | Field       | Type        | Null | Key | Default | Extra          |
 +-------------+-------------+------+-----+---------+----------------+
@@ -82,8 +90,72 @@ CREATE TABLE `covidcast` (
   PRIMARY KEY (`id`),
   -- for uniqueness, and also fast lookup of all locations on a given date
   UNIQUE KEY (`source`, `signal`, `time_type`, `geo_type`, `time_value`, `geo_value`),
-  -- for fast lookup of a time-series for a given location
-  KEY (`source`, `signal`, `time_type`, `geo_type`, `geo_value`, `time_value`)
+  -- for fast lookup of a time-series for a given location (this index is named
+  -- so that queries can explicitly refer to it)
+  KEY `ix_ts` (`source`, `signal`, `time_type`, `geo_type`, `geo_value`, `time_value`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+/*
+`covidcast_series` summarizes each time-series in `covidcast`, so that stale
+time-series can be found without aggregating the whole `covidcast` table.
+
+Data is public.
+
+This table is maintained by the acquisition code as rows are upserted into
+`covidcast` and as `direction` is updated. It must be populated once after it
+is created on a database which already has `covidcast` rows, and rebuilt
+whenever `covidcast` is modified by other means, by running:
+
+  python3 -m delphi.epidata.acquisition.covidcast.covidcast_series_builder
+
+which is equivalent to:
+
+  DELETE FROM covidcast_series;
+  INSERT INTO covidcast_series
+    SELECT source, signal, time_type, geo_type, geo_value, MAX(timestamp1),
+      MIN(timestamp2), MIN(time_value), MAX(time_value), COUNT(1)
+    FROM covidcast
+    GROUP BY source, signal, time_type, geo_type, geo_value;
+
++----------------+-------------+------+-----+---------+-------+
+| Field          | Type        | Null | Key | Default | Extra |
++----------------+-------------+------+-----+---------+-------+
+| source         | varchar(32) | NO   | PRI | NULL    |       |
+| signal         | varchar(32) | NO   | PRI | NULL    |       |
+| time_type      | varchar(12) | NO   | PRI | NULL    |       |
+| geo_type       | varchar(12) | NO   | PRI | NULL    |       |
+| geo_value      | varchar(12) | NO   | PRI | NULL    |       |
+| max_timestamp1 | int(11)     | NO   |     | NULL    |       |
+| min_timestamp2 | int(11)     | NO   |     | NULL    |       |
+| min_day        | int(11)     | NO   |     | NULL    |       |
+| max_day        | int(11)     | NO   |     | NULL    |       |
+| series_length  | int(11)     | NO   |     | NULL    |       |
++----------------+-------------+------+-----+---------+-------+
+
+- `source`, `signal`, `time_type`, `geo_type`, `geo_value`
+  same as in `covidcast`, together identifying a time-series
+- `max_timestamp1`
+  latest `timestamp1` of any row in the time-series
+- `min_timestamp2`
+  earliest `timestamp2` of any row in the time-series
+- `min_day`, `max_day`
+  earliest and latest `time_value` in the time-series
+- `series_length`
+  number of rows in the time-series
+*/
+
+CREATE TABLE `covidcast_series` (
+  `source` varchar(32) NOT NULL,
+  `signal` varchar(32) NOT NULL,
+  `time_type` varchar(12) NOT NULL,
+  `geo_type` varchar(12) NOT NULL,
+  `geo_value` varchar(12) NOT NULL,
+  `max_timestamp1` int(11) NOT NULL,
+  `min_timestamp2` int(11) NOT NULL,
+  `min_day` int(11) NOT NULL,
+  `max_day` int(11) NOT NULL,
+  `series_length` int(11) NOT NULL,
+  PRIMARY KEY (`source`, `signal`, `time_type`, `geo_type`, `geo_value`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 /*
@@ -113,3 +185,39 @@ CREATE TABLE `covidcast_meta_cache` (
   PRIMARY KEY (`timestamp`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 INSERT INTO covidcast_meta_cache VALUES (0, '');
+
+/*
+`covidcast_stdev_cache` stores the standard deviation of each signal's values
+over all locations and days, which is used as a scaling factor when computing
+`direction`. Computing this requires a full scan of `covidcast`, so it is
+cached here and only recomputed when the cache is stale.
+
+Data is public.
+
++-----------------+-------------+------+-----+---------+-------+
+| Field           | Type        | Null | Key | Default | Extra |
++-----------------+-------------+------+-----+---------+-------+
+| source          | varchar(32) | NO   | PRI | NULL    |       |
+| signal          | varchar(32) | NO   | PRI | NULL    |       |
+| geo_type        | varchar(12) | NO   | PRI | NULL    |       |
+| aggregate_stdev | double      | NO   |     | NULL    |       |
+| timestamp       | int(11)     | NO   |     | NULL    |       |
++-----------------+-------------+------+-----+---------+-------+
+
+- `source`, `signal`, `geo_type`
+  same as in `covidcast`
+- `aggregate_stdev`
+  standard deviation of `value` over all locations and days (`time_type` of
+  'day' only)
+- `timestamp`
+  unix time in seconds when `aggregate_stdev` was computed
+*/
+
+CREATE TABLE `covidcast_stdev_cache` (
+  `source` varchar(32) NOT NULL,
+  `signal` varchar(32) NOT NULL,
+  `geo_type` varchar(12) NOT NULL,
+  `aggregate_stdev` double NOT NULL,
+  `timestamp` int(11) NOT NULL,
+  PRIMARY KEY (`source`, `signal`, `geo_type`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
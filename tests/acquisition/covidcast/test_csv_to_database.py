@@ -2,8 +2,9 @@
 
 # standard library
 import argparse
+import concurrent.futures
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 # py3tester coverage target
 __test_target__ = 'delphi.epidata.acquisition.covidcast.csv_to_database'
@@ -54,22 +55,27 @@ class UnitTests(unittest.TestCase):
     mock_csv_importer.load_csv = load_csv_impl
     mock_file_archiver = MagicMock()
 
-    scan_upload_archive(
+    num_rows = scan_upload_archive(
         data_dir,
         mock_database,
         csv_importer_impl=mock_csv_importer,
         file_archiver_impl=mock_file_archiver)
 
-    # verify that five rows were added to the database
-    self.assertEqual(mock_database.insert_or_update.call_count, 5)
-    call_args_list = mock_database.insert_or_update.call_args_list
+    # verify that five rows were added to the database in two batches
+    self.assertEqual(num_rows, 5)
+    self.assertEqual(mock_database.insert_or_update_file.call_count, 2)
+    call_args_list = mock_database.insert_or_update_file.call_args_list
     actual_args = [args for (args, kwargs) in call_args_list]
     expected_args = [
-      ('src_a', 'sig_a', 'day', 'hrr', 20200419, 'a1', 'a1', 'a1', 'a1'),
-      ('src_a', 'sig_a', 'day', 'hrr', 20200419, 'a2', 'a2', 'a2', 'a2'),
-      ('src_a', 'sig_a', 'day', 'hrr', 20200419, 'a3', 'a3', 'a3', 'a3'),
-      ('src_b', 'sig_b', 'week', 'msa', 202016, 'b1', 'b1', 'b1', 'b1'),
-      ('src_b', 'sig_b', 'week', 'msa', 202016, 'b3', 'b3', 'b3', 'b3'),
+      ('src_a', 'sig_a', 'day', 'hrr', 20200419, [
+        ('a1', 'a1', 'a1', 'a1'),
+        ('a2', 'a2', 'a2', 'a2'),
+        ('a3', 'a3', 'a3', 'a3'),
+      ]),
+      ('src_b', 'sig_b', 'week', 'msa', 202016, [
+        ('b1', 'b1', 'b1', 'b1'),
+        ('b3', 'b3', 'b3', 'b3'),
+      ]),
     ]
     self.assertEqual(actual_args, expected_args)
 
@@ -84,14 +90,108 @@ class UnitTests(unittest.TestCase):
     ]
     self.assertEqual(actual_args, expected_args)
 
+  def test_scan_upload_archive_bulk_load(self):
+    """Let the database load and validate CSVs when bulk loading."""
+
+    data_dir = 'data_dir'
+    mock_database = MagicMock()
+    mock_database.bulk_load_csv.side_effect = [(True, 3), (False, 2)]
+    mock_csv_importer = MagicMock()
+    mock_csv_importer.find_csv_files.return_value = [
+      ('path/a.csv', ('src_a', 'sig_a', 'day', 'hrr', 20200419)),
+      ('path/b.csv', ('src_b', 'sig_b', 'week', 'msa', 202016)),
+    ]
+    mock_file_archiver = MagicMock()
+
+    num_rows = scan_upload_archive(
+        data_dir,
+        mock_database,
+        csv_importer_impl=mock_csv_importer,
+        file_archiver_impl=mock_file_archiver,
+        bulk_load=True)
+
+    # verify that both files were loaded by the database
+    self.assertEqual(num_rows, 5)
+    self.assertFalse(mock_csv_importer.load_csv.called)
+    self.assertFalse(mock_database.insert_or_update_file.called)
+    call_args_list = mock_database.bulk_load_csv.call_args_list
+    actual_args = [args for (args, kwargs) in call_args_list]
+    expected_args = [
+      ('path/a.csv', 'src_a', 'sig_a', 'day', 'hrr', 20200419),
+      ('path/b.csv', 'src_b', 'sig_b', 'week', 'msa', 202016),
+    ]
+    self.assertEqual(actual_args, expected_args)
+
+    # verify that one file was successful (a) and one failed (b)
+    call_args_list = mock_file_archiver.archive_file.call_args_list
+    actual_args = [args for (args, kwargs) in call_args_list]
+    expected_args = [
+      ('path', 'data_dir/archive/successful/src_a', 'a.csv', True),
+      ('path', 'data_dir/archive/failed/src_b', 'b.csv', False),
+    ]
+    self.assertEqual(actual_args, expected_args)
+
+  def test_scan_upload_archive_parallel(self):
+    """Upload files concurrently, each on its own connection."""
+
+    def load_csv_impl(path, *args):
+      # file "b" has a validation error
+      yield MagicMock(geo_value='x', value=1, stderr=2, sample_size=3)
+      if path == 'path/b.csv':
+        yield None
+
+    data_dir = 'data_dir'
+    mock_database = MagicMock()
+    worker_databases = [MagicMock(), MagicMock()]
+    worker_databases_iter = iter(worker_databases)
+    mock_database_impl = lambda: next(worker_databases_iter)
+    mock_csv_importer = MagicMock()
+    mock_csv_importer.find_csv_files.return_value = [
+      ('path/a.csv', ('src_a', 'sig_a', 'day', 'hrr', 20200419)),
+      ('path/b.csv', ('src_b', 'sig_b', 'week', 'msa', 202016)),
+      ('path/c.csv', None),
+    ]
+    mock_csv_importer.load_csv = load_csv_impl
+    mock_file_archiver = MagicMock()
+
+    num_rows = scan_upload_archive(
+        data_dir,
+        mock_database,
+        csv_importer_impl=mock_csv_importer,
+        file_archiver_impl=mock_file_archiver,
+        num_workers=2,
+        database_impl=mock_database_impl)
+    self.assertEqual(num_rows, 2)
+
+    # verify that each file was uploaded and committed by its own worker
+    self.assertFalse(mock_database.insert_or_update_file.called)
+    uploaded_sources = []
+    for worker_database in worker_databases:
+      self.assertTrue(worker_database.connect.called)
+      kwargs = worker_database.connect.call_args[1]
+      self.assertFalse(kwargs['allow_local_infile'])
+      self.assertTrue(worker_database.disconnect.call_args[0][0])
+      source = worker_database.insert_or_update_file.call_args[0][0]
+      uploaded_sources.append(source)
+    self.assertEqual(sorted(uploaded_sources), ['src_a', 'src_b'])
+
+    # verify that one file was successful (a) and two failed (b, c)
+    call_args_list = mock_file_archiver.archive_file.call_args_list
+    actual_args = [args for (args, kwargs) in call_args_list]
+    expected_args = [
+      ('path', 'data_dir/archive/failed/unknown', 'c.csv', False),
+      ('path', 'data_dir/archive/successful/src_a', 'a.csv', True),
+      ('path', 'data_dir/archive/failed/src_b', 'b.csv', False),
+    ]
+    self.assertEqual(actual_args, expected_args)
+
   def test_main_successful(self):
     """Run the main program and successfully commit changes."""
 
-    args = MagicMock(data_dir='data', test=False)
+    args = MagicMock(data_dir='data', test=False, num_workers=1)
     mock_database = MagicMock()
-    mock_database.count_all_rows.return_value = 0
     mock_database_impl = lambda: mock_database
-    mock_scan_upload_archive = MagicMock()
+    mock_scan_upload_archive = MagicMock(return_value=5)
 
     main(
         args=args,
@@ -108,9 +208,8 @@ class UnitTests(unittest.TestCase):
   def test_main_unsuccessful(self):
     """Run the main program but don't commit changes on failure."""
 
-    args = MagicMock(data_dir='data', test=False)
+    args = MagicMock(data_dir='data', test=False, num_workers=1)
     mock_database = MagicMock()
-    mock_database.count_all_rows.return_value = 0
     mock_database_impl = lambda: mock_database
     mock_scan_upload_archive = MagicMock(side_effect=Exception('testing'))
 
@@ -130,11 +229,10 @@ class UnitTests(unittest.TestCase):
   def test_main_testing(self):
     """Run the main program but don't commit changes when testing."""
 
-    args = MagicMock(data_dir='data', test=True)
+    args = MagicMock(data_dir='data', test=True, num_workers=1)
     mock_database = MagicMock()
-    mock_database.count_all_rows.return_value = 0
     mock_database_impl = lambda: mock_database
-    mock_scan_upload_archive = MagicMock()
+    mock_scan_upload_archive = MagicMock(return_value=5)
 
     main(
         args=args,
@@ -148,3 +246,141 @@ class UnitTests(unittest.TestCase):
     self.assertTrue(mock_database.disconnect.called)
     actual_args = mock_database.disconnect.call_args[0]
     self.assertFalse(mock_database.disconnect.call_args[0][0])
+
+  def test_scan_upload_archive_parallel_deadlock(self):
+    """Retry a file whose upload deadlocked."""
+
+    def load_csv_impl(path, *args):
+      yield MagicMock(geo_value='x', value=1, stderr=2, sample_size=3)
+
+    deadlock = Exception('deadlock')
+    deadlock.errno = 1213
+    worker_databases = [MagicMock(), MagicMock()]
+    worker_databases[0].insert_or_update_file.side_effect = deadlock
+    worker_databases_iter = iter(worker_databases)
+    mock_database_impl = lambda: next(worker_databases_iter)
+    mock_csv_importer = MagicMock()
+    mock_csv_importer.find_csv_files.return_value = [
+      ('path/a.csv', ('src_a', 'sig_a', 'day', 'hrr', 20200419)),
+    ]
+    mock_csv_importer.load_csv = load_csv_impl
+    mock_file_archiver = MagicMock()
+
+    num_rows = scan_upload_archive(
+        'data_dir',
+        MagicMock(),
+        csv_importer_impl=mock_csv_importer,
+        file_archiver_impl=mock_file_archiver,
+        num_workers=2,
+        database_impl=mock_database_impl)
+
+    # verify that the first attempt was rolled back, and the second committed
+    self.assertEqual(num_rows, 1)
+    self.assertFalse(worker_databases[0].disconnect.call_args[0][0])
+    self.assertTrue(worker_databases[1].disconnect.call_args[0][0])
+    call_args_list = mock_file_archiver.archive_file.call_args_list
+    actual_args = [args for (args, kwargs) in call_args_list]
+    expected_args = [
+      ('path', 'data_dir/archive/successful/src_a', 'a.csv', True),
+    ]
+    self.assertEqual(actual_args, expected_args)
+
+  def test_scan_upload_archive_parallel_error(self):
+    """Don't retry a file whose upload failed for another reason."""
+
+    def load_csv_impl(path, *args):
+      yield MagicMock(geo_value='x', value=1, stderr=2, sample_size=3)
+
+    worker_database = MagicMock()
+    worker_database.insert_or_update_file.side_effect = Exception('testing')
+    mock_database_impl = MagicMock(return_value=worker_database)
+    mock_csv_importer = MagicMock()
+    mock_csv_importer.find_csv_files.return_value = [
+      ('path/a.csv', ('src_a', 'sig_a', 'day', 'hrr', 20200419)),
+    ]
+    mock_csv_importer.load_csv = load_csv_impl
+    mock_file_archiver = MagicMock()
+
+    with self.assertRaises(Exception):
+      scan_upload_archive(
+          'data_dir',
+          MagicMock(),
+          csv_importer_impl=mock_csv_importer,
+          file_archiver_impl=mock_file_archiver,
+          num_workers=2,
+          database_impl=mock_database_impl)
+
+    self.assertEqual(mock_database_impl.call_count, 1)
+    self.assertFalse(worker_database.disconnect.call_args[0][0])
+    self.assertFalse(mock_file_archiver.archive_file.called)
+
+  def test_scan_upload_archive_parallel_error_archives_committed(self):
+    """Archive files which were committed before another upload failed."""
+
+    def load_csv_impl(path, *args):
+      yield MagicMock(geo_value='x', value=1, stderr=2, sample_size=3)
+
+    # the upload of file "a" fails, and that of file "b" is committed
+    worker_databases = {'src_a': MagicMock(), 'src_b': MagicMock()}
+    worker_databases['src_a'].insert_or_update_file.side_effect = (
+        Exception('testing'))
+    mock_database_impl = MagicMock(side_effect=[
+      worker_databases['src_a'],
+      worker_databases['src_b'],
+    ])
+    mock_csv_importer = MagicMock()
+    mock_csv_importer.find_csv_files.return_value = [
+      ('path/a.csv', ('src_a', 'sig_a', 'day', 'hrr', 20200419)),
+      ('path/b.csv', ('src_b', 'sig_b', 'day', 'hrr', 20200419)),
+    ]
+    mock_csv_importer.load_csv = load_csv_impl
+    mock_file_archiver = MagicMock()
+
+    with patch('concurrent.futures.ThreadPoolExecutor') as mock_pool_impl:
+      # run uploads in order, in the main thread
+      pool = mock_pool_impl.return_value.__enter__.return_value
+      def submit(func, *args):
+        future = concurrent.futures.Future()
+        try:
+          future.set_result(func(*args))
+        except Exception as e:
+          future.set_exception(e)
+        return future
+      pool.submit = submit
+
+      with self.assertRaises(UploadError) as context:
+        scan_upload_archive(
+            'data_dir',
+            MagicMock(),
+            csv_importer_impl=mock_csv_importer,
+            file_archiver_impl=mock_file_archiver,
+            num_workers=2,
+            database_impl=mock_database_impl)
+
+    self.assertEqual(context.exception.num_rows, 1)
+    self.assertFalse(worker_databases['src_a'].disconnect.call_args[0][0])
+    self.assertTrue(worker_databases['src_b'].disconnect.call_args[0][0])
+    call_args_list = mock_file_archiver.archive_file.call_args_list
+    actual_args = [args for (args, kwargs) in call_args_list]
+    expected_args = [
+      ('path', 'data_dir/archive/successful/src_b', 'b.csv', True),
+    ]
+    self.assertEqual(actual_args, expected_args)
+
+  def test_main_worker_commits(self):
+    """Report rows committed by workers when another upload failed."""
+
+    args = MagicMock(data_dir='data', test=False, num_workers=2)
+    mock_database = MagicMock()
+    mock_database_impl = lambda: mock_database
+    mock_scan_upload_archive = MagicMock(side_effect=UploadError(5))
+
+    with patch('builtins.print') as mock_print:
+      with self.assertRaises(UploadError):
+        main(
+            args=args,
+            database_impl=mock_database_impl,
+            scan_upload_archive_impl=mock_scan_upload_archive)
+
+    mock_print.assert_called_with('uploaded=5 committed=True')
+    self.assertFalse(mock_database.disconnect.call_args[0][0])
@@ -1,8 +1,10 @@
 """Unit tests for database.py."""
 
 # standard library
+import os
+import tempfile
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 # py3tester coverage target
 __test_target__ = 'delphi.epidata.acquisition.covidcast.database'
@@ -20,6 +22,27 @@ class UnitTests(unittest.TestCase):
     database.connect(connector_impl=mock_connector)
 
     self.assertTrue(mock_connector.connect.called)
+    connection = mock_connector.connect()
+    # the prepared cursor is only created when it's needed
+    for args, kwargs in connection.cursor.call_args_list:
+      self.assertNotIn('prepared', kwargs)
+    kwargs = mock_connector.connect.call_args_list[0][1]
+    self.assertEqual(kwargs['pool_name'], Database.POOL_NAME)
+    self.assertEqual(kwargs['pool_size'], Database.POOL_SIZE)
+    self.assertFalse(kwargs['autocommit'])
+    self.assertFalse(kwargs['allow_local_infile'])
+
+  def test_connect_allowing_local_infile(self):
+    """Connect from a separate pool when local files are allowed."""
+
+    mock_connector = MagicMock()
+    database = Database()
+
+    database.connect(connector_impl=mock_connector, allow_local_infile=True)
+
+    kwargs = mock_connector.connect.call_args_list[0][1]
+    self.assertNotEqual(kwargs['pool_name'], Database.POOL_NAME)
+    self.assertTrue(kwargs['allow_local_infile'])
 
   def test_disconnect_with_rollback(self):
     """Disconnect from the database and rollback."""
@@ -33,6 +56,7 @@ class UnitTests(unittest.TestCase):
 
     connection = mock_connector.connect()
     self.assertFalse(connection.commit.called)
+    self.assertTrue(connection.rollback.called)
     self.assertTrue(connection.close.called)
 
   def test_disconnect_with_commit(self):
@@ -62,7 +86,7 @@ class UnitTests(unittest.TestCase):
     cursor = connection.cursor()
     cursor.__iter__.return_value = [(123,)]
 
-    num = database.count_all_rows()
+    num = database.count_all_rows(exact=True)
 
     self.assertEqual(num, 123)
     self.assertTrue(cursor.execute.called)
@@ -71,6 +95,32 @@ class UnitTests(unittest.TestCase):
     self.assertIn('select count(1)', sql)
     self.assertIn('from `covidcast`', sql)
 
+  def test_count_all_rows_estimate_query(self):
+    """Query to estimate the number of rows is reasonable.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    cursor.__iter__.return_value = [(123,)]
+
+    num = database.count_all_rows()
+
+    self.assertEqual(num, 123)
+    self.assertTrue(cursor.execute.called)
+
+    sql, args = cursor.execute.call_args[0]
+    self.assertEqual(args, (Database.DATABASE_NAME,))
+
+    sql = sql.lower()
+    self.assertIn('`table_rows`', sql)
+    self.assertIn('`information_schema`.`tables`', sql)
+    self.assertNotIn('count(1)', sql)
+
   def test_insert_or_update_query(self):
     """Query to insert/update a row is reasonable.
 
@@ -91,45 +141,521 @@ class UnitTests(unittest.TestCase):
     mock_connector = MagicMock()
     database = Database()
     database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+
+    with patch('time.time', return_value=123.4):
+      database.insert_or_update(*row)
+
+    # find the existing row, update the summary, and write the row
+    self.assertEqual(cursor.execute.call_count, 3)
+
+    sql = cursor.execute.call_args_list[1][0][0].lower()
+    self.assertIn('insert into `covidcast_series`', sql)
+
+    sql, args = cursor.execute.call_args[0]
+    self.assertEqual(args, row[:6] + (123,) + row[6:])
+
+    sql = sql.lower()
+    self.assertIn('insert into', sql)
+    self.assertIn('`covidcast`', sql)
+    self.assertNotIn('unix_timestamp', sql)
+
+  def test_insert_or_update_many_duplicates(self):
+    """Keep only the last of several rows with the same key."""
+
+    rows = [
+      ('src', 'sig', 'day', 'state', 20200101, 'pa', 1, 2, 3),
+      ('src', 'sig', 'day', 'state', 20200101, 'wa', 4, 5, 6),
+      ('src', 'sig', 'day', 'state', 20200101, 'pa', 7, 8, 9),
+    ]
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
 
-    database.insert_or_update(*row)
+    with patch('time.time', return_value=123.4):
+      database.insert_or_update_many(rows)
 
     connection = mock_connector.connect()
     cursor = connection.cursor()
-    self.assertTrue(cursor.execute.called)
+
+    # each new key adds one row to its time-series
+    sql, args = cursor.execute.call_args_list[1][0]
+    self.assertIn('insert into `covidcast_series`', sql.lower())
+    self.assertEqual(args[9::10], (1, 1))
 
     sql, args = cursor.execute.call_args[0]
-    self.assertEqual(args, row)
+    self.assertIn('insert into `covidcast`', sql.lower())
+    expected_args = tuple(
+      value
+      for row in (rows[2], rows[1])
+      for value in row[:6] + (123,) + row[6:]
+    )
+    self.assertEqual(args, expected_args)
+
+  def test_insert_or_update_batch_query(self):
+    """Query to insert/update a batch of rows is reasonable.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    rows = [
+      (
+        'source',
+        'signal',
+        'time_type',
+        'geo_type',
+        'time_value',
+        'geo_value%d' % i,
+        'value',
+        'stderr',
+        'sample_size',
+      )
+      for i in range(5)
+    ]
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+
+    with patch('time.time', return_value=123.4):
+      database.insert_or_update_batch(rows, batch_size=2)
+
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    insert_calls = [
+      args for (args, kwargs) in cursor.execute.call_args_list
+      if 'insert into `covidcast` values' in args[0].lower()
+    ]
+    self.assertEqual(len(insert_calls), 3)
+
+    def expected_args(row):
+      return row[:6] + (123,) + row[6:]
+
+    sql, args = insert_calls[0]
+    self.assertEqual(args, expected_args(rows[0]) + expected_args(rows[1]))
+    self.assertEqual(sql.count('%s'), len(args))
+
+    sql, args = insert_calls[2]
+    self.assertEqual(args, expected_args(rows[4]))
+    self.assertEqual(sql.count('%s'), len(args))
 
     sql = sql.lower()
     self.assertIn('insert into', sql)
     self.assertIn('`covidcast`', sql)
-    self.assertIn('unix_timestamp', sql)
+    self.assertNotIn('unix_timestamp', sql)
+    # rows inserted concurrently since they were looked up are updated
     self.assertIn('on duplicate key update', sql)
 
-  def test_get_rows_with_stale_direction_query(self):
-    """Query to get rows with stale `direction` is reasonable.
+  def test_insert_or_update_batch_updates_series(self):
+    """Account for upserted rows in the time-series summary.
 
     NOTE: Actual behavior is tested by integration test.
     """
 
+    rows = [
+      ('src', 'sig', 'day', 'state', 20200101, 'pa', 1, 2, 3),
+      ('src', 'sig', 'day', 'state', 20200102, 'pa', 1, 2, 3),
+      ('src', 'sig', 'day', 'state', 20200101, 'wa', 1, 2, 3),
+    ]
     mock_connector = MagicMock()
     database = Database()
     database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    # only the first row already exists
+    cursor.__iter__.return_value = [rows[0][:6]]
 
-    result = database.get_rows_with_stale_direction()
+    with patch('time.time', return_value=123.4):
+      database.insert_or_update_batch(rows)
+
+    self.assertEqual(cursor.execute.call_count, 4)
+    sql, args = cursor.execute.call_args_list[1][0]
+    expected_args = (
+      'src', 'sig', 'day', 'state', 'pa', 123, 0, 20200101, 20200102, 1,
+      'src', 'sig', 'day', 'state', 'wa', 123, 0, 20200101, 20200101, 1,
+    )
+    self.assertEqual(args, expected_args)
 
-    self.assertIsInstance(result, list)
+    sql = sql.lower()
+    self.assertIn('insert into `covidcast_series`', sql)
+    self.assertIn('`series_length` = `series_length` + values', sql)
+
+    # new rows are inserted
+    sql, args = cursor.execute.call_args_list[2][0]
+    self.assertIn('insert into `covidcast` values', sql.lower())
+    self.assertEqual(args, (
+      rows[1][:6] + (123,) + rows[1][6:] + rows[2][:6] + (123,) + rows[2][6:]
+    ))
+
+    # existing rows are updated
+    sql, args = cursor.execute.call_args_list[3][0]
+    self.assertEqual(args, rows[0] + (123,))
+    self.assertEqual(sql.count('%s'), len(args))
+
+    sql = sql.lower()
+    self.assertIn('update', sql)
+    self.assertIn('`covidcast` c', sql)
+    self.assertNotIn('insert', sql)
 
+  def test_insert_or_update_file_query(self):
+    """Query to insert/update the rows of a file is reasonable.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    rows = [
+      ('pa', 1, 2, 3),
+      ('wa', 4, 5, 6),
+      ('pa', 7, 8, 9),
+    ]
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
     connection = mock_connector.connect()
     cursor = connection.cursor()
-    self.assertTrue(cursor.execute.called)
+    # only "pa" already exists
+    cursor.__iter__.return_value = [('pa',)]
+
+    with patch('time.time', return_value=123.4):
+      database.insert_or_update_file(
+          'src', 'sig', 'day', 'state', 20200101, rows)
+
+    self.assertEqual(cursor.execute.call_count, 4)
+
+    # only the values which vary between rows are parameters
+    sql, args = cursor.execute.call_args_list[0][0]
+    self.assertEqual(args, ('pa', 'wa'))
+    self.assertEqual(sql.count('%s'), len(args))
+    self.assertIn("`source` = 'src'", sql)
+    self.assertIn('`time_value` = 20200101', sql)
+
+    sql, args = cursor.execute.call_args_list[1][0]
+    self.assertIn('insert into `covidcast_series`', sql.lower())
+
+    sql, args = cursor.execute.call_args_list[2][0]
+    self.assertEqual(args, ('wa', 123, 4, 5, 6))
+    self.assertEqual(sql.count('%s'), len(args))
+    self.assertIn("'src', 'sig', 'day', 'state', 20200101", sql)
+    self.assertIn('on duplicate key update', sql.lower())
+
+    # the last row given for "pa" is kept
+    sql, args = cursor.execute.call_args_list[3][0]
+    self.assertEqual(args, ('pa', 7, 8, 9, 123))
+    self.assertEqual(sql.count('%s'), len(args))
+    self.assertIn("c.`signal` = 'sig'", sql)
+
+  def test_insert_or_update_file_unsafe_literals(self):
+    """Pass shared values as parameters when they aren't safe as literals."""
+
+    database = Database()
+    database.insert_or_update_batch = MagicMock()
+
+    database.insert_or_update_file(
+        "src'", 'sig', 'day', 'state', 20200101, [('pa', 1, 2, 3)])
+
+    args, kwargs = database.insert_or_update_batch.call_args
+    self.assertEqual(
+        args,
+        ([("src'", 'sig', 'day', 'state', 20200101, 'pa', 1, 2, 3)],))
+
+  def test_insert_or_update_batch_series_order(self):
+    """Upsert time-series summaries in key order."""
+
+    rows = [
+      ('src', 'sig', 'day', 'state', 20200101, 'wa', 1, 2, 3),
+      ('src', 'sig', 'day', 'state', 20200101, 'pa', 1, 2, 3),
+    ]
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+
+    database.insert_or_update_batch(rows)
+
+    sql, args = cursor.execute.call_args_list[1][0]
+    self.assertIn('insert into `covidcast_series`', sql.lower())
+    self.assertEqual(args[4::10], ('pa', 'wa'))
+
+  def test_is_deadlock(self):
+    """Recognize errors which report a deadlock."""
+
+    deadlock = Exception('deadlock')
+    deadlock.errno = 1213
+    other = Exception('other')
+    other.errno = 1062
+
+    self.assertTrue(Database.is_deadlock(deadlock))
+    self.assertFalse(Database.is_deadlock(other))
+    self.assertFalse(Database.is_deadlock(Exception('no errno')))
+
+  def test_insert_or_update_batch_existing_series(self):
+    """Mark a time-series stale even if all of its upserted rows exist.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    rows = [
+      ('src', 'sig', 'day', 'state', 20200101, 'pa', 1, 2, 3),
+      ('src', 'sig', 'day', 'state', 20200102, 'pa', 1, 2, 3),
+    ]
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    cursor.__iter__.return_value = [row[:6] for row in rows]
+
+    with patch('time.time', return_value=123.4):
+      database.insert_or_update_batch(rows)
+
+    sql, args = cursor.execute.call_args_list[1][0]
+    self.assertIn('insert into `covidcast_series`', sql.lower())
+    expected_args = (
+      'src', 'sig', 'day', 'state', 'pa', 123, 0, 20200101, 20200102, 0,
+    )
+    self.assertEqual(args, expected_args)
+
+  def test_bulk_load_csv_query(self):
+    """Queries to bulk load a CSV file are reasonable.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    cursor.__iter__.return_value = [(1, 0)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, '20200419_state_sig.csv')
+      with open(path, 'w') as f:
+        f.write('geo_id,extra,val,se,sample_size\n')
+        f.write('pa,x,1,2,30\n')
+
+      result = database.bulk_load_csv(
+          path, 'src', 'sig', 'day', 'state', 20200419)
+
+    self.assertEqual(result, (True, 1))
+
+    statements = [args[0].lower() for (args, kwargs) in
+        cursor.execute.call_args_list]
+    load_sql = [sql for sql in statements if 'load data' in sql][0]
+    self.assertIn('local infile', load_sql)
+    self.assertIn("lines terminated by '\\n'", load_sql)
+    self.assertIn('(`geo_id`, @unused, `val`, `se`, `sample_size`)', load_sql)
+
+    sql, args = cursor.execute.call_args_list[-2][0]
+    self.assertEqual(args[:5], ('src', 'sig', 'day', 'state', 20200419))
+    sql = sql.lower()
+    self.assertIn('insert into `covidcast`', sql)
+    self.assertIn('from\n        `covidcast_load_staging`', sql)
+    self.assertIn('on duplicate key update', sql)
+    # values are missing when pandas would read them as such
+    self.assertIn("'null'", sql)
+    self.assertIn("'#n/a'", sql)
+
+    # repeated geo values are counted once in the time-series summary
+    sql = cursor.execute.call_args_list[-3][0][0].lower()
+    self.assertIn('insert into `covidcast_series`', sql)
+    self.assertIn('select distinct', sql)
+
+  def test_bulk_load_csv_crlf(self):
+    """Split lines of a CSV file on CRLF if its header ends that way."""
+
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    cursor.__iter__.return_value = [(1, 0)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, '20200419_state_sig.csv')
+      with open(path, 'w', newline='') as f:
+        f.write('geo_id,val,se,sample_size\r\n')
+        f.write('pa,1,2,30\r\n')
+
+      result = database.bulk_load_csv(
+          path, 'src', 'sig', 'day', 'state', 20200419)
+
+    self.assertEqual(result, (True, 1))
+
+    statements = [args[0].lower() for (args, kwargs) in
+        cursor.execute.call_args_list]
+    load_sql = [sql for sql in statements if 'load data' in sql][0]
+    self.assertIn("lines terminated by '\\r\\n'", load_sql)
+    self.assertIn('(`geo_id`, `val`, `se`, `sample_size`)', load_sql)
+
+  def test_bulk_load_csv_invalid(self):
+    """Report invalid rows and headers when bulk loading a CSV file."""
+
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    cursor.__iter__.return_value = [(0, 1)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, '20200419_state_sig.csv')
+      with open(path, 'w') as f:
+        f.write('geo_id,val,se,sample_size\n')
+        f.write('pennsylvania,1,2,30\n')
+
+      self.assertEqual(
+          database.bulk_load_csv(path, 'src', 'sig', 'day', 'state', 20200419),
+          (False, 0))
+
+      with open(path, 'w') as f:
+        f.write('geo_id,val\n')
+        f.write('pa,1\n')
+
+      cursor.execute.reset_mock()
+      self.assertEqual(
+          database.bulk_load_csv(path, 'src', 'sig', 'day', 'state', 20200419),
+          (False, 0))
+      self.assertFalse(cursor.execute.called)
+
+  def test_get_data_stdev_across_locations_cached(self):
+    """Read standard deviations from a fresh cache.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    cursor.__iter__.return_value = [('src', 'sig', 'state', 1.5)]
+
+    result = database.get_data_stdev_across_locations()
+
+    self.assertEqual(result, [('src', 'sig', 'state', 1.5)])
+    self.assertEqual(cursor.execute.call_count, 1)
 
     sql = cursor.execute.call_args[0][0].lower()
     self.assertIn('select', sql)
+    self.assertIn('`covidcast_stdev_cache`', sql)
+
+  def test_get_data_stdev_across_locations_refreshes_stale_cache(self):
+    """Compute standard deviations, and refresh the cache, when it is stale.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    cursor.__iter__.side_effect = [
+      iter([]),
+      iter([('src', 'sig', 'state', 1.5), ('src', 'sig', 'county', 2.5)]),
+    ]
+
+    result = database.get_data_stdev_across_locations()
+
+    self.assertEqual(result, [
+      ('src', 'sig', 'county', 2.5),
+      ('src', 'sig', 'state', 1.5),
+    ])
+    self.assertEqual(cursor.execute.call_count, 3)
+
+    # the aggregate is read without locking `covidcast`
+    sql = cursor.execute.call_args_list[1][0][0].lower()
+    self.assertIn('std(`value`)', sql)
+    self.assertNotIn('insert', sql)
+
+    sql, args = cursor.execute.call_args_list[2][0]
+    self.assertEqual(sql.count('%s'), len(args))
+    self.assertEqual(args[:4], ('src', 'sig', 'county', 2.5))
+    sql = sql.lower()
+    self.assertIn('insert into `covidcast_stdev_cache`', sql)
+    self.assertNotIn('select', sql)
+    self.assertIn('on duplicate key update', sql)
+
+  def test_get_rows_with_stale_direction_query(self):
+    """Query to get rows with stale `direction` is reasonable.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    key = ('src', 'sig', 'state', 'pa', 456, 123, 20200101, 20200107, 7)
+    row = ('src', 'sig', 'day', 'state', 20200107, 'pa', 123, 456, 7)
+    cursor.fetchmany.side_effect = [[key], [], [row], []]
+
+    result = database.get_rows_with_stale_direction()
+
+    self.assertEqual(len(list(result)), 1)
+    self.assertEqual(cursor.execute.call_count, 2)
+
+    sql, args = cursor.execute.call_args[0]
+    self.assertEqual(args, ('src', 'sig', 'state', 'pa'))
+    self.assertEqual(sql.count('%s'), len(args))
+
+    sql = sql.lower()
+    self.assertIn('select', sql)
     self.assertIn('`covidcast`', sql)
-    self.assertIn('join', sql)
-    self.assertIn('datediff', sql)
+    # the row constructor covers the leading columns of the hinted index
+    self.assertIn(
+        "(`source`, `signal`, `time_type`, `geo_type`, `geo_value`) in "
+        "((%s, %s, 'day', %s, %s))",
+        sql)
+    self.assertIn('over w', sql)
+    self.assertIn('6 preceding', sql)
+    self.assertNotIn('join', sql)
+    self.assertNotIn('rand()', sql)
+
+  def test_get_rows_with_stale_direction_more_series(self):
+    """Read more time-series while fewer stale rows than the limit are found."""
+
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    key1 = ('src', 'sig', 'state', 'pa', 456, 123, 20200101, 20200107, 10000)
+    key2 = ('src', 'sig', 'state', 'ny', 456, 123, 20200101, 20200107, 10000)
+    row = ('src', 'sig', 'day', 'state', 20200107, 'pa', 123, 456, 7)
+    cursor.fetchmany.side_effect = [[key1, key2], [], [row], [], [row], []]
+
+    result = database.get_rows_with_stale_direction()
+
+    self.assertEqual(len(list(result)), 2)
+    self.assertEqual(cursor.execute.call_count, 3)
+
+    # each batch has one time-series, and only asks for the rows still needed
+    first_sql, first_args = cursor.execute.call_args_list[1][0]
+    second_sql, second_args = cursor.execute.call_args_list[2][0]
+    self.assertEqual(len(first_args), 4)
+    self.assertEqual(len(second_args), 4)
+    self.assertNotEqual(first_args, second_args)
+    self.assertIn('10000', first_sql)
+    self.assertIn('9999', second_sql)
+
+  def test_get_rows_with_stale_direction_when_fresh(self):
+    """Don't query for stale rows when no time-series is potentially stale."""
+
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    cursor.fetchmany.return_value = []
+
+    result = database.get_rows_with_stale_direction()
+
+    self.assertEqual(list(result), [])
+    self.assertEqual(cursor.execute.call_count, 1)
 
   def test_get_rows_to_compute_direction_query(self):
     """Query to get rows needed to compute `direction` is reasonable.
@@ -147,13 +673,13 @@ class UnitTests(unittest.TestCase):
     mock_connector = MagicMock()
     database = Database()
     database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    cursor.fetchall.return_value = [(-1, 2), (0, 3)]
 
     result = database.get_rows_to_compute_direction(*args)
 
-    self.assertIsInstance(result, list)
-
-    connection = mock_connector.connect()
-    cursor = connection.cursor()
+    self.assertEqual(result, [(-1, 2), (0, 3)])
     self.assertTrue(cursor.execute.called)
 
     sql, args = cursor.execute.call_args[0]
@@ -191,7 +717,8 @@ class UnitTests(unittest.TestCase):
     database = Database()
     database.connect(connector_impl=mock_connector)
 
-    database.update_direction(*args)
+    with patch('time.time', return_value=123.4):
+      database.update_direction(*args)
 
     connection = mock_connector.connect()
     cursor = connection.cursor()
@@ -199,6 +726,7 @@ class UnitTests(unittest.TestCase):
 
     sql, args = cursor.execute.call_args[0]
     expected_args = (
+      123,
       'direction',
       'source',
       'signal',
@@ -212,5 +740,233 @@ class UnitTests(unittest.TestCase):
     sql = sql.lower()
     self.assertIn('update', sql)
     self.assertIn('`covidcast`', sql)
-    self.assertIn('`timestamp2` = unix_timestamp', sql)
+    self.assertIn('`timestamp2` = %s', sql)
     self.assertIn('`direction` = %s', sql)
+    self.assertIn('use index (`ix_ts`)', sql)
+
+  def test_update_direction_batch_query(self):
+    """Query to update a batch of rows' `direction` is reasonable.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    key = (
+      'source',
+      'signal',
+      'time_type',
+      'geo_type',
+      'time_value',
+      'geo_value',
+    )
+    rows = [key + (1,), key + (-1,), key + (1,), key + (0,)]
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+
+    with patch('time.time', return_value=123.4):
+      database.update_direction_batch(rows, batch_size=3)
+
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    # one query per direction in each batch
+    self.assertEqual(cursor.execute.call_count, 3)
+
+    sql, args = cursor.execute.call_args_list[0][0]
+    self.assertEqual(args, (123, 1) + key * 2)
+    self.assertEqual(sql.count('%s'), len(args))
+
+    sql, args = cursor.execute.call_args_list[1][0]
+    self.assertEqual(args, (123, -1) + key)
+
+    sql, args = cursor.execute.call_args_list[2][0]
+    self.assertEqual(args, (123, 0) + key)
+    self.assertEqual(sql.count('%s'), len(args))
+
+    sql = sql.lower()
+    self.assertIn('update', sql)
+    self.assertIn('`covidcast`', sql)
+    self.assertNotIn('insert', sql)
+    self.assertIn('`direction` = %s', sql)
+
+  def test_get_daily_timeseries_for_direction_update_query(self):
+    """Query to get a daily time-series is reasonable and streams its rows.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    args = ('source', 'signal', 'geo_type', 'geo_value', 'min_day', 'max_day')
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    cursor.fetchmany.side_effect = [[(0, 20200101, 1, 2, 3)], []]
+
+    result = database.get_daily_timeseries_for_direction_update(*args)
+
+    self.assertEqual(list(result), [(0, 20200101, 1, 2, 3)])
+    self.assertTrue(cursor.close.called)
+    self.assertIn('buffered', connection.cursor.call_args[1])
+
+    sql, args = cursor.execute.call_args[0]
+    expected_args = (
+      'min_day',
+      'source',
+      'signal',
+      'geo_type',
+      'geo_value',
+      'min_day',
+      'max_day',
+    )
+    self.assertEqual(args, expected_args)
+
+    sql = sql.lower()
+    self.assertIn('select', sql)
+    self.assertIn('`covidcast`', sql)
+    self.assertIn('datediff', sql)
+
+  def test_get_all_stale_timeseries_query(self):
+    """Query to get all stale time-series is reasonable and groups rows.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    key_a = ('src', 'sig', 'state', 'ca', 456, 123, 20200101, 20200102, 2)
+    key_b = ('src', 'sig', 'state', 'wa', 456, 123, 20200101, 20200101, 1)
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    cursor.fetchmany.side_effect = [
+      # the stale keys
+      [key_a, key_b],
+      [],
+      # the first batch of time-series
+      [
+        key_a + (0, 20200101, 1, 456, 123),
+        key_a + (1, 20200102, 2, 456, 123),
+      ],
+      [],
+      # the second batch of time-series
+      [
+        key_b + (0, 20200101, 3, 456, 123),
+      ],
+      [],
+    ]
+
+    result = database.get_all_stale_timeseries(batch_size=1)
+
+    expected_result = [
+      (key_a, [(0, 20200101, 1, 456, 123), (1, 20200102, 2, 456, 123)]),
+      (key_b, [(0, 20200101, 3, 456, 123)]),
+    ]
+    self.assertEqual(list(result), expected_result)
+    self.assertEqual(cursor.execute.call_count, 3)
+
+    sql = cursor.execute.call_args_list[0][0][0]
+    self.assertIn('`covidcast_series`', sql)
+    self.assertNotIn('join', sql.lower())
+
+    sql, args = cursor.execute.call_args_list[1][0]
+    self.assertEqual(args, key_a[:4])
+    self.assertEqual(sql.count('%s'), len(args))
+
+    sql = sql.lower()
+    self.assertIn('select', sql)
+    self.assertIn('`covidcast`', sql)
+    self.assertIn('join', sql)
+    self.assertIn('`covidcast_series`', sql)
+    self.assertNotIn('group by', sql)
+
+    sql, args = cursor.execute.call_args_list[2][0]
+    self.assertEqual(args, key_b[:4])
+
+  def test_get_all_stale_timeseries_given_keys(self):
+    """Get stale time-series for the given keys, in batches."""
+
+    keys = [
+      ('src', 'sig', 'state', 'geo%d' % i, 456, 123, 20200101, 20200101, 1)
+      for i in range(3)
+    ]
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    cursor.fetchmany.return_value = []
+
+    result = list(database.get_all_stale_timeseries(keys, batch_size=2))
+
+    self.assertEqual(result, [])
+    self.assertEqual(cursor.execute.call_count, 2)
+    sql, args = cursor.execute.call_args_list[0][0]
+    self.assertEqual(args, keys[0][:4] + keys[1][:4])
+    sql, args = cursor.execute.call_args_list[1][0]
+    self.assertEqual(args, keys[2][:4])
+
+  def test_update_timeseries_timestamp2_query(self):
+    """Query to update `timestamp2` of a time-series is reasonable.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    mock_connector = MagicMock()
+    connection = mock_connector.connect()
+    regular_cursor, prepared_cursor = MagicMock(), MagicMock()
+    connection.cursor.side_effect = (
+        lambda **kwargs: prepared_cursor if kwargs.get('prepared')
+        else regular_cursor)
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+
+    with patch('time.time', return_value=123.4):
+      database.update_timeseries_timestamp2('src', 'sig', 'day', 'state', 'pa')
+
+    # each cursor runs a single statement, which stays prepared
+    expected_args = (123, 'src', 'sig', 'day', 'state', 'pa')
+    sql, args = prepared_cursor.execute.call_args[0]
+    self.assertEqual(prepared_cursor.execute.call_count, 1)
+    self.assertEqual(args, expected_args)
+    self.assertIn('`covidcast`', sql)
+
+    sql, args = regular_cursor.execute.call_args[0]
+    self.assertEqual(regular_cursor.execute.call_count, 1)
+    self.assertEqual(args, expected_args)
+    self.assertIn('`covidcast_series`', sql)
+
+  def test_update_timeseries_timestamp2_batch_query(self):
+    """Query to update `timestamp2` of many time-series is reasonable.
+
+    NOTE: Actual behavior is tested by integration test.
+    """
+
+    key = ('source', 'signal', 'time_type', 'geo_type', 'geo_value')
+    mock_connector = MagicMock()
+    database = Database()
+    database.connect(connector_impl=mock_connector)
+
+    with patch('time.time', return_value=123.4):
+      database.update_timeseries_timestamp2_batch([key] * 3, batch_size=2)
+
+    connection = mock_connector.connect()
+    cursor = connection.cursor()
+    self.assertEqual(cursor.execute.call_count, 4)
+
+    sql, args = cursor.execute.call_args_list[0][0]
+    self.assertEqual(args, (123,) + key * 2)
+    self.assertEqual(sql.count('%s'), 1 + len(key) * 2)
+
+    sql, args = cursor.execute.call_args_list[1][0]
+    self.assertEqual(args, (123,) + key * 2)
+    self.assertIn('`covidcast_series`', sql)
+    self.assertIn('`min_timestamp2` = %s', sql)
+
+    sql, args = cursor.execute.call_args_list[2][0]
+    self.assertEqual(args, (123,) + key)
+
+    sql = sql.lower()
+    self.assertIn('update', sql)
+    self.assertIn('`covidcast`', sql)
+    self.assertIn('`timestamp2` = %s', sql)
+    self.assertIn(') in (', sql)
@@ -17,11 +17,91 @@ class UnitTests(unittest.TestCase):
 
     self.assertIsInstance(get_argument_parser(), argparse.ArgumentParser)
 
-  # TODO: this is temporary, will write test ASAP
-  # def test_update_loop(self):
-  #   """Update direction for out-of-date covidcast rows."""
-  #
-  #   self.assertTrue(False)
+  def test_update_loop(self):
+    """Update direction for out-of-date covidcast rows."""
+
+    keys = [
+      ('src', 'sig_a', 'state', 'pa', 456, 123, 20200101, 20200102, 2),
+      ('src', 'sig_a', 'state', 'wa', 456, 123, 20200101, 20200102, 2),
+      ('src', 'sig_b', 'county', '42003', 456, 123, 20200101, 20200102, 2),
+    ]
+    timeseries_rows = [
+      (0, 20200101, 1.5, 456, 123),
+      (1, 20200102, 2.5, 456, 0),
+    ]
+    mock_database = MagicMock()
+    mock_database.get_keys_with_potentially_stale_direction.return_value = (
+        iter(keys))
+    mock_database.get_all_stale_timeseries.return_value = (
+        iter([(key, timeseries_rows) for key in keys]))
+    # the cache doesn't yet have the second signal
+    mock_database.get_data_stdev_across_locations.side_effect = [
+      [('src', 'sig_a', 'state', 1.1)],
+      [('src', 'sig_a', 'state', 1.1), ('src', 'sig_b', 'county', 2.2)],
+    ]
+    mock_direction = MagicMock()
+    mock_direction.scan_timeseries.return_value = ([20200101, 20200102], [1, 0])
+
+    update_loop(mock_database, direction_impl=mock_direction, batch_size=3)
+
+    # verify that the cache was refreshed for the unknown signal
+    call_args_list = mock_database.get_data_stdev_across_locations.call_args_list
+    self.assertEqual(len(call_args_list), 2)
+    self.assertEqual(call_args_list[1][1], {'max_age': 0})
+    data_stdevs = [
+      args[-1] for (args, kwargs) in
+      mock_direction.scan_timeseries.call_args_list
+    ]
+    self.assertEqual(data_stdevs, [1.1, 1.1, 2.2])
+
+    # verify that time-series were read for the stale keys
+    args, kwargs = mock_database.get_all_stale_timeseries.call_args
+    self.assertEqual(list(args[0]), keys)
+
+    # verify that direction updates were flushed once the buffer was full, and
+    # that the remaining updates were written at the end
+    call_args_list = mock_database.update_direction_batch.call_args_list
+    actual_args = [args[0] for (args, kwargs) in call_args_list]
+    expected_args = [
+      [
+        ('src', 'sig_a', 'day', 'state', 20200101, 'pa', 1),
+        ('src', 'sig_a', 'day', 'state', 20200102, 'pa', 0),
+        ('src', 'sig_a', 'day', 'state', 20200101, 'wa', 1),
+        ('src', 'sig_a', 'day', 'state', 20200102, 'wa', 0),
+      ],
+      [
+        ('src', 'sig_b', 'day', 'county', 20200101, '42003', 1),
+        ('src', 'sig_b', 'day', 'county', 20200102, '42003', 0),
+      ],
+    ]
+    self.assertEqual(actual_args, expected_args)
+
+    # verify that all three time-series were marked fresh in a single batch
+    call_args_list = (
+        mock_database.update_timeseries_timestamp2_batch.call_args_list)
+    actual_args = [args[0] for (args, kwargs) in call_args_list]
+    expected_args = [
+      [
+        ('src', 'sig_a', 'day', 'state', 'pa'),
+        ('src', 'sig_a', 'day', 'state', 'wa'),
+        ('src', 'sig_b', 'day', 'county', '42003'),
+      ],
+    ]
+    self.assertEqual(actual_args, expected_args)
+
+  def test_update_loop_nothing_stale(self):
+    """Don't write anything when no time-series is stale."""
+
+    mock_database = MagicMock()
+    mock_database.get_keys_with_potentially_stale_direction.return_value = (
+        iter([]))
+    mock_database.get_all_stale_timeseries.return_value = iter([])
+    mock_database.get_data_stdev_across_locations.return_value = []
+
+    update_loop(mock_database, direction_impl=MagicMock())
+
+    self.assertFalse(mock_database.update_direction_batch.called)
+    self.assertFalse(mock_database.update_timeseries_timestamp2_batch.called)
 
   def test_main_successful(self):
     """Run the main program and successfully commit changes."""